@@ -0,0 +1,295 @@
+'''
+  ghmiles benchmarks
+
+  The benchmarks run against a local stand-in of the GitHub v2 API serving a
+  synthetic repository, so they do not need network access and their results
+  can be compared from one run to another.
+
+  Usage: python benchmarks.py [options] [benchmark ...]
+
+  :copyright: Copyright 2011 Barthelemy Dagenais
+  :license: BSD, see LICENSE for details
+'''
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+from urlparse import urlparse, parse_qs
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib
+
+import ghmiles
+
+PROJECT = 'bench/project'
+
+OTHER_LABELS = ['bug', 'feature', 'documentation', 'wontfix']
+
+DATE = '2011/02/01 10:00:00 -0800'
+
+
+#### SYNTHETIC REPOSITORY ####
+
+def make_labels(label_count):
+    '''Returns label_count milestone labels of the form vX.Y followed by a few
+    labels that are not milestones.'''
+    return ['v{0}.{1}'.format(index // 10, index % 10) for index in
+            range(label_count)] + OTHER_LABELS
+
+def make_issues(issue_count, labels):
+    '''Returns issue_count issue dicts, as sent by the v2 API, spread over the
+    milestone labels. Three issues out of five are closed.'''
+    milestone_labels = labels[:-len(OTHER_LABELS)]
+    issues = []
+    for number in range(1, issue_count + 1):
+        issue_labels = [milestone_labels[number % len(milestone_labels)]]
+        if number % 7 == 0:
+            issue_labels.append('bug')
+        state = 'closed' if number % 5 < 3 else 'open'
+        issues.append({'number': number, 'position': float(number),
+            'votes': 0, 'user': 'someone', 'gravatar_id': 'a' * 32,
+            'title': u'Issue number {0} of the benchmark'.format(number),
+            'body': u'Description of the issue. ' * 10, 'state': state,
+            'labels': issue_labels, 'created_at': DATE, 'updated_at': DATE,
+            'closed_at': DATE if state == 'closed' else None})
+    return issues
+
+
+class FakeGithubServer(ThreadingMixIn, HTTPServer):
+    '''Local HTTP server answering the v2 API requests made by ghmiles for a
+    single synthetic repository. Responses are serialized once, except the
+    pages of label lists requested with `page` and `per_page`.'''
+
+    daemon_threads = True
+
+    def __init__(self, labels, issues):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGithubHandler)
+        prefix = '/api/v2/json/issues/'
+        self.responses = {}
+        self.label_issues = {}
+        self.responses[prefix + 'labels/' + PROJECT] = json.dumps(
+                {'labels': labels})
+        for state in ('open', 'closed'):
+            self.responses['{0}list/{1}/{2}'.format(prefix, PROJECT, state)] = \
+                json.dumps({'issues': [issue for issue in issues
+                    if issue['state'] == state]})
+        for label in labels:
+            path = '{0}list/{1}/label/{2}'.format(prefix, PROJECT, label)
+            self.label_issues[path] = [issue for issue in issues
+                    if label in issue['labels']]
+            self.responses[path] = json.dumps(
+                    {'issues': self.label_issues[path]})
+        self.requests = 0
+
+    @property
+    def url_prefix(self):
+        return 'http://127.0.0.1:{0}/api/v2/json'.format(self.server_port)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+
+    # Keeps the connections alive, like the GitHub API. Without Nagle's
+    # algorithm, the small writes of a response are not delayed.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests += 1
+        # github2 sends absolute URIs as request targets.
+        url = urlparse(self.path)
+        path = urllib.unquote(url.path)
+        query = parse_qs(url.query)
+        if 'per_page' in query and path in self.server.label_issues:
+            per_page = int(query['per_page'][0])
+            start = (int(query.get('page', ['1'])[0]) - 1) * per_page
+            body = json.dumps({'issues':
+                self.server.label_issues[path][start:start + per_page]})
+        else:
+            body = self.server.responses.get(path)
+        if body is None:
+            self.send_response(404)
+            body = json.dumps({'error': [{'error': 'not found'}]})
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_client(server):
+    github = ghmiles.Github()
+    github.request.url_prefix = server.url_prefix
+    return github
+
+
+#### BENCHMARKS ####
+
+class Benchmark(object):
+    '''A benchmark is a setup function returning the state used by the run
+    function, and the number of items processed by each run.'''
+
+    def __init__(self, name, setup, run):
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+
+def setup_labels(options):
+    labels = make_labels(options.labels)
+    return (labels, len(labels))
+
+def run_label_sort(labels):
+    ghmiles._label_keys.clear()
+    ghmiles._component_keys.clear()
+    sorted(labels, key=ghmiles.label_key)
+
+def run_intel_labels(labels):
+    ghmiles.classify_milestone_labels(labels)
+
+def setup_server(options):
+    labels = make_labels(options.labels)
+    server = FakeGithubServer(labels, make_issues(options.issues, labels))
+    server.start()
+    return ((server, make_client(server)), options.issues)
+
+def run_milestones(state):
+    (_, github) = state
+    list(ghmiles.get_milestones(PROJECT, ghmiles.MILESTONE_LABEL_V,
+        github=github))
+
+def run_milestones_bulk(state):
+    (_, github) = state
+    list(ghmiles.get_milestones(PROJECT, ghmiles.MILESTONE_LABEL_V,
+        github=github, bulk=True))
+
+def run_milestones_stream(state):
+    (_, github) = state
+    list(ghmiles.get_milestones(PROJECT, ghmiles.MILESTONE_LABEL_V,
+        github=github, page_size=100))
+
+def setup_milestones(options):
+    labels = make_labels(options.labels)
+    issues = [ghmiles.IssueRecord(issue['number'], issue['title'],
+        issue['state'], issue['labels']) for issue in
+        make_issues(options.issues, labels)]
+    index = ghmiles.index_issues_by_label(issues)
+    milestones = list(ghmiles.get_milestones_from_index(
+        labels[:-len(OTHER_LABELS)], index))
+    return (milestones, options.issues)
+
+def run_simple_html(milestones):
+    ghmiles.get_simple_html_page(milestones, 'Benchmark')
+
+def run_fancy_html(milestones):
+    ghmiles.get_fancy_html_page(milestones, PROJECT)
+
+def setup_startup(options):
+    return (None, 1)
+
+def run_startup(state):
+    subprocess.check_call([sys.executable, '-c', 'import ghmiles'])
+
+
+BENCHMARKS = [
+    Benchmark('startup', setup_startup, run_startup),
+    Benchmark('label_sort', setup_labels, run_label_sort),
+    Benchmark('intel_labels', setup_labels, run_intel_labels),
+    Benchmark('milestones', setup_server, run_milestones),
+    Benchmark('milestones_bulk', setup_server, run_milestones_bulk),
+    Benchmark('milestones_stream', setup_server, run_milestones_stream),
+    Benchmark('simple_html', setup_milestones, run_simple_html),
+    Benchmark('fancy_html', setup_milestones, run_fancy_html),
+]
+
+
+def max_rss():
+    '''Returns the peak resident memory of the process in KB (Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(benchmark, options):
+    '''Runs a benchmark in the current process and returns a dict with the
+    best time, the throughput and the peak memory used above the setup.'''
+    (state, items) = benchmark.setup(options)
+    rss = max_rss()
+    # Warm up (e.g., imports and memoized label keys)
+    benchmark.run(state)
+    times = []
+    for _ in range(options.repeat):
+        start = time.time()
+        benchmark.run(state)
+        times.append(time.time() - start)
+    best = min(times)
+    return {'name': benchmark.name, 'items': items, 'seconds': best,
+            'throughput': items / best if best else None,
+            'peak_kb': max_rss() - rss}
+
+def run_isolated(benchmark, options, argv):
+    '''Runs a benchmark in a new process so that its peak memory is not
+    affected by the other benchmarks.'''
+    output = subprocess.check_output([sys.executable, __file__, '--child'] +
+            argv + [benchmark.name])
+    return json.loads(output)
+
+
+#### COMMAND LINE ####
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-l', '--labels', type='int', default=50,
+            help='number of milestone labels [default: %default]')
+    parser.add_option('-i', '--issues', type='int', default=5000,
+            help='number of issues [default: %default]')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+            help='number of timed runs, the best is reported '
+            '[default: %default]')
+    parser.add_option('-j', '--json', action='store_true', default=False,
+            help='print the results as JSON')
+    parser.add_option('--child', action='store_true', default=False,
+            help='run the benchmarks in this process (internal)')
+    (options, names) = parser.parse_args(argv)
+
+    benchmarks = [benchmark for benchmark in BENCHMARKS
+            if not names or benchmark.name in names]
+    if not benchmarks:
+        parser.error('unknown benchmark: {0}'.format(' '.join(names)))
+
+    if options.child:
+        result = run_benchmark(benchmarks[0], options)
+        sys.stdout.write(json.dumps(result))
+        return 0
+
+    child_argv = ['-l', str(options.labels), '-i', str(options.issues),
+            '-r', str(options.repeat)]
+    results = [run_isolated(benchmark, options, child_argv)
+            for benchmark in benchmarks]
+
+    if options.json:
+        sys.stdout.write(json.dumps(results, indent=2) + '\n')
+    else:
+        sys.stdout.write('{0} milestone labels, {1} issues, best of {2}\n'
+                .format(options.labels, options.issues, options.repeat))
+        sys.stdout.write('{0:<18} {1:>10} {2:>14} {3:>10}\n'.format(
+            'benchmark', 'ms', 'items/s', 'peak KB'))
+        for result in results:
+            sys.stdout.write('{0:<18} {1:>10.2f} {2:>14.0f} {3:>10}\n'.format(
+                result['name'], result['seconds'] * 1000,
+                result['throughput'] or 0, result['peak_kb']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,20 +5,596 @@
   :copyright: Copyright 2011 Barthelemy Dagenais
   :license: BSD, see LICENSE for details
 '''
-# Necessary for monkey patching
-from github2.request import GithubRequest
-from github2.users import Users
-from github2.repositories import Repositories
-from github2.commits import Commits
-import time
-import sys
-
-from github2.issues import Issues, Issue
-from github2.client import Github
+# github2 and the heavier standard modules are imported when they are first
+# needed so that importing ghmiles stays cheap (see patch_github2).
+from string import Formatter
+import threading
 import datetime
 import StringIO
+import bisect
+import cPickle as pickle
+import time
+import sys
+import os
 import re
 
+#### RATE LIMITING ####
+
+class RateLimiter(object):
+    '''Thread-safe token bucket limiting the number of API requests.
+
+    A limiter can be shared by several threads and several Github clients so
+    that they all draw from the same budget. When GitHub reports a remaining
+    quota lower than the bucket (e.g., because other clients use the same
+    account), the bucket is drained to match.
+
+    :param requests_per_minute: the rate at which tokens are refilled.
+    :param burst: the maximum number of tokens that can accumulate while the
+           client is idle. Defaults to `requests_per_minute`.
+    :param debug: if True, delays are reported on stderr.
+    '''
+
+    def __init__(self, requests_per_minute=60, burst=None, debug=False):
+        self.requests_per_minute = requests_per_minute
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst or requests_per_minute)
+        self.tokens = self.capacity
+        self.debug = debug
+        self.last_refill = time.time()
+        self.reset_at = None
+        self.sleeping = 0
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.waits = 0
+        self.throttled = 0
+        self.sleep_time = 0.0
+
+    def _refill(self, now):
+        if self.reset_at is not None:
+            if now < self.reset_at:
+                # The server quota is exhausted: no token comes back before
+                # it is renewed, whatever the local rate.
+                self.last_refill = now
+                return
+            # The server quota was renewed: tokens reserved by sleeping
+            # callers are still owed.
+            self.tokens = min(self.capacity, self.tokens + self.capacity)
+            self.reset_at = None
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def acquire(self, max_wait=None):
+        '''Takes a token, sleeping until one is available.
+
+        :param max_wait: if the token is not available within max_wait
+               seconds, `DeadlineExceeded` is raised at once and no token is
+               taken. (optional)
+        :return: the number of seconds spent sleeping.
+        '''
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            # The token is reserved even if we have to wait for it so that
+            # concurrent callers queue behind each other.
+            self.tokens -= 1
+            if self.tokens >= 0 and self.reset_at is None:
+                self.requests += 1
+                return 0.0
+            if self.reset_at is not None:
+                duration = self.reset_at - now
+            else:
+                duration = -self.tokens / self.rate
+            if max_wait is not None and duration > max_wait:
+                self.tokens += 1
+                raise DeadlineExceeded(duration)
+            self.requests += 1
+            self.waits += 1
+            self.sleep_time += duration
+            self.sleeping += 1
+
+        if self.debug:
+            sys.stderr.write("delaying API call %s\n" % duration)
+        try:
+            time.sleep(duration)
+        finally:
+            with self.lock:
+                self.sleeping -= 1
+
+        return duration
+
+    def wait_time(self):
+        '''Returns the number of seconds a call to `acquire` would sleep.'''
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            if self.tokens >= 1 and self.reset_at is None:
+                return 0.0
+            if self.reset_at is not None:
+                return self.reset_at - now
+            return (1 - self.tokens) / self.rate
+
+    def update(self, remaining=None, reset=None):
+        '''Adjusts the bucket to the quota reported by the server.
+
+        :param remaining: the number of requests left in the current window.
+        :param reset: the time (seconds since the epoch) at which the quota
+               is renewed, if known.
+        '''
+        if remaining is None:
+            return
+        with self.lock:
+            self._refill(time.time())
+            if remaining > 0 and self.reset_at is not None:
+                # The quota was renewed before the reported reset: callers
+                # no longer wait for it.
+                self.reset_at = None
+                self.tokens = min(self.capacity, float(remaining)) - \
+                        self.sleeping
+            else:
+                self.tokens = min(self.tokens,
+                        float(remaining) - self.sleeping)
+            if remaining <= 0:
+                self.throttled += 1
+                self.reset_at = reset
+
+    def update_from_headers(self, getheader):
+        '''Reads the X-RateLimit headers of a response.
+
+        :param getheader: a function returning the value of a header or None
+               (e.g., `HTTPResponse.getheader`).
+        '''
+        try:
+            remaining = getheader('X-RateLimit-Remaining')
+            reset = getheader('X-RateLimit-Reset')
+            remaining = int(remaining) if remaining is not None else None
+            reset = float(reset) if reset is not None else None
+        except ValueError:
+            return
+        self.update(remaining, reset)
+
+    def stats(self):
+        '''Returns a dict with the number of requests, the number of waits,
+        the number of times the server reported an exhausted quota, and the
+        total time spent sleeping.'''
+        with self.lock:
+            return {'requests': self.requests, 'waits': self.waits,
+                    'throttled': self.throttled,
+                    'sleep_time': self.sleep_time}
+
+
+class DeadlineExceeded(RuntimeError):
+    '''Raised when a request cannot be made before the deadline of the
+    current thread (see `get_milestones_within`). `wait` is the number of
+    seconds the request would have had to wait for the rate limiter.'''
+
+    def __init__(self, wait=0.0):
+        RuntimeError.__init__(self,
+                'Request delayed by {0:.1f}s past the deadline'.format(wait))
+        self.wait = wait
+
+
+class QuotaExceeded(RuntimeError):
+    '''Raised when GitHub refuses a request because the rate limit quota
+    of the account is exhausted. `reset` is the time (seconds since the
+    epoch) at which the quota is renewed, or None if it is unknown.'''
+
+    def __init__(self, reset=None):
+        RuntimeError.__init__(self, 'GitHub rate limit quota exhausted')
+        self.reset = reset
+
+_deadlines = threading.local()
+
+def _max_wait():
+    '''Returns the number of seconds left before the deadline of the current
+    thread, or None if it has no deadline.'''
+    deadline = getattr(_deadlines, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+#### RESPONSE CACHE ####
+
+class ResponseCache(object):
+    '''Base class of the caches storing the responses of the GitHub API.
+
+    An entry is a dict with the response `body`, the `etag` and
+    `last_modified` validators sent by GitHub, and the time at which it was
+    `stored`. Entries younger than `ttl` seconds are used without contacting
+    GitHub. Older entries are revalidated with a conditional request.
+
+    Subclasses implement `get`, `set` and `clear`.
+
+    :param ttl: the number of seconds during which an entry is considered
+           fresh.
+    :param max_entries: the maximum number of entries kept by the cache.
+    '''
+
+    def __init__(self, ttl=60, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] < self.ttl
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, entry):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+
+class MemoryCache(ResponseCache):
+    '''Response cache kept in memory. The least recently used entries are
+    evicted first.'''
+
+    def __init__(self, ttl=60, max_entries=1000):
+        from collections import OrderedDict
+        ResponseCache.__init__(self, ttl, max_entries)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DirectoryCache(ResponseCache):
+    '''Response cache storing one JSON file per entry in a directory. The
+    oldest entries are evicted first.
+
+    :param path: the directory where the entries are stored. It is created
+           if necessary.
+    '''
+
+    suffix = '.json'
+
+    def __init__(self, path, ttl=60, max_entries=1000):
+        ResponseCache.__init__(self, ttl, max_entries)
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _entry_path(self, key):
+        import hashlib
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return os.path.join(self.path,
+                hashlib.sha1(key).hexdigest() + self.suffix)
+
+    def _entry_paths(self):
+        return [os.path.join(self.path, name) for name in
+                os.listdir(self.path) if name.endswith(self.suffix)]
+
+    def get(self, key):
+        import json
+        try:
+            with open(self._entry_path(key)) as entry_file:
+                return json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+
+    def set(self, key, entry):
+        import json
+        write_file_atomically(self._entry_path(key), json.dumps(entry))
+        entry_paths = self._entry_paths()
+        if len(entry_paths) > self.max_entries:
+            entry_paths.sort(key=_safe_mtime)
+            for entry_path in entry_paths[:-self.max_entries]:
+                _safe_remove(entry_path)
+
+    def clear(self):
+        for entry_path in self._entry_paths():
+            _safe_remove(entry_path)
+
+
+def write_file_atomically(path, content, mode='w'):
+    '''Writes content to a temporary file and renames it to path so that
+    readers never see a partially written file.'''
+    write_chunks_atomically(path, (content,), mode)
+
+def write_chunks_atomically(path, chunks, mode='w'):
+    '''Same as `write_file_atomically`, but the content is provided as an
+    iterable of strings.'''
+    temp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+            threading.current_thread().ident)
+    try:
+        with open(temp_path, mode) as temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+        _replace_file(temp_path, path)
+    except:
+        _safe_remove(temp_path)
+        raise
+
+def _replace_file(source, destination):
+    if os.name == 'nt' and os.path.exists(destination):
+        # Windows does not allow rename to overwrite an existing file.
+        os.remove(destination)
+    os.rename(source, destination)
+
+def _safe_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+def _safe_remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+#### INSTRUMENTATION ####
+
+class Metrics(object):
+    '''Records where the time of a roadmap build is spent: API requests
+    (latency, size, status), responses served by the cache, time spent
+    waiting for the rate limiter, and phases (label listing, milestone
+    fetching, rendering).
+
+    Attach the metrics to a client with `Github(metrics=metrics)` and pass
+    them to the HTML writers with their `metrics` argument.
+
+    :param callbacks: a list of functions called with the kind of each event
+           (`request`, `cache_hit`, `sleep` or `phase`) and a dict describing
+           it. Callbacks can be called from several threads. (optional)
+    '''
+
+    def __init__(self, callbacks=None):
+        self.callbacks = list(callbacks or ())
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.request_seconds = 0.0
+            self.bytes = 0
+            self.errors = 0
+            self.cache_hits = 0
+            self.revalidated = 0
+            self.sleeps = 0
+            self.sleep_seconds = 0.0
+            self.phases = {}
+
+    def _notify(self, kind, event):
+        for callback in self.callbacks:
+            callback(kind, event)
+
+    def record_request(self, url, status, seconds, size, revalidated=False):
+        with self.lock:
+            self.requests += 1
+            self.request_seconds += seconds
+            self.bytes += size
+            if status >= 400:
+                self.errors += 1
+            if revalidated:
+                self.revalidated += 1
+        self._notify('request', {'url': url, 'status': status,
+            'seconds': seconds, 'bytes': size, 'revalidated': revalidated})
+
+    def record_cache_hit(self, url):
+        with self.lock:
+            self.cache_hits += 1
+        self._notify('cache_hit', {'url': url})
+
+    def record_sleep(self, seconds):
+        if not seconds:
+            return
+        with self.lock:
+            self.sleeps += 1
+            self.sleep_seconds += seconds
+        self._notify('sleep', {'seconds': seconds})
+
+    def record_phase(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+            phase['count'] += 1
+            phase['seconds'] += seconds
+        self._notify('phase', {'name': name, 'seconds': seconds})
+
+    def phase(self, name):
+        '''Returns a context manager recording the time spent in its block
+        as the phase `name`.'''
+        return _Phase(self, name)
+
+    def summary(self):
+        '''Returns a dict summarizing the recorded events.'''
+        with self.lock:
+            return {'requests': self.requests,
+                    'request_seconds': self.request_seconds,
+                    'bytes': self.bytes, 'errors': self.errors,
+                    'cache_hits': self.cache_hits,
+                    'revalidated': self.revalidated,
+                    'rate_limit_sleeps': self.sleeps,
+                    'rate_limit_seconds': self.sleep_seconds,
+                    'phases': dict((name, dict(phase)) for (name, phase) in
+                        self.phases.items())}
+
+    def to_json(self, indent=None):
+        import json
+        return json.dumps(self.summary(), indent=indent, sort_keys=True)
+
+
+class _Phase(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.metrics is not None:
+            self.metrics.record_phase(self.name, time.time() - self.start)
+        return False
+
+def _phase(github, name):
+    return _Phase(_client_metrics(github), name)
+
+def _client_metrics(github):
+    return getattr(getattr(github, 'request', None), 'metrics', None)
+
+#### TRANSPORT ####
+
+class Transport(object):
+    '''Sends the requests of Github clients over persistent (keep-alive)
+    connections pooled per host, so that consecutive requests do not pay a
+    new TCP and TLS handshake. Responses are requested gzipped and decoded,
+    and failed requests are retried with an exponential backoff.
+
+    A transport is thread-safe and can be shared by several clients.
+
+    :param timeout: the timeout of the connections in seconds. (optional)
+    :param retries: the number of times a GET request is retried after a
+           connection error or a 5xx response. (optional)
+    :param backoff: the delay before the first retry in seconds. The delay
+           doubles at each retry. (optional)
+    :param max_idle: the maximum number of idle connections kept per host.
+           (optional)
+    :param gzip: if True (default), responses are requested gzipped.
+    '''
+
+    def __init__(self, timeout=60, retries=2, backoff=0.5, max_idle=4,
+            gzip=True):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self.gzip = gzip
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+        self.retried = 0
+
+    def request(self, connector, netloc, method, path, body=None,
+            headers=None):
+        '''Sends a request and reads its response.
+
+        :param connector: the connection class (e.g.,
+               `httplib.HTTPSConnection`).
+        :param netloc: the host (and port) to connect to.
+        :return: A `TransportResponse`, already read.
+        '''
+        import httplib
+        import socket
+        headers = dict(headers or {})
+        if self.gzip:
+            headers['Accept-Encoding'] = 'gzip'
+        idempotent = method.upper() in ('GET', 'HEAD')
+        retries = self.retries if idempotent else 0
+        attempt = 0
+        while True:
+            (connection, reused) = self._acquire(connector, netloc)
+            sent = False
+            try:
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+                response_body = response.read()
+            except (socket.error, httplib.HTTPException) as error:
+                connection.close()
+                if reused and idempotent and \
+                        not isinstance(error, socket.timeout) and \
+                        (not sent or isinstance(error, httplib.BadStatusLine)):
+                    # The server closed the idle connection before reading
+                    # the request or without answering it: try again on a
+                    # new one without waiting.
+                    continue
+                if attempt >= retries:
+                    raise
+            else:
+                response = TransportResponse(response, response_body)
+                if response.reusable:
+                    self._release(connector, netloc, connection)
+                else:
+                    connection.close()
+                if response.status < 500 or attempt >= retries:
+                    return response
+            self._wait(attempt)
+            attempt += 1
+
+    def _acquire(self, connector, netloc):
+        with self.lock:
+            connections = self.idle.get((connector, netloc))
+            if connections:
+                self.reused += 1
+                return (connections.pop(), True)
+            self.opened += 1
+        # The port is kept so that a local stand-in of the API can be used.
+        return (connector(netloc, timeout=self.timeout), False)
+
+    def _release(self, connector, netloc, connection):
+        with self.lock:
+            connections = self.idle.setdefault((connector, netloc), [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _wait(self, attempt):
+        with self.lock:
+            self.retried += 1
+        time.sleep(self.backoff * 2 ** attempt)
+
+    def stats(self):
+        '''Returns the number of connections opened and reused, and the
+        number of retries.'''
+        with self.lock:
+            return {'opened': self.opened, 'reused': self.reused,
+                    'retried': self.retried}
+
+    def close(self):
+        '''Closes the idle connections.'''
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class TransportResponse(object):
+    '''Response read by a `Transport`. The body is decoded if it was
+    gzipped.'''
+
+    def __init__(self, response, body):
+        self.status = response.status
+        self.getheader = response.getheader
+        if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            import zlib
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.body = body
+        self.reusable = not getattr(response, 'will_close', False) and \
+                (response.getheader('Connection') or '').lower() != 'close'
+
+    def read(self):
+        return self.body
+
+
 #### MONKEY PATCH github2 ####
 
 def list_by_label(self, project, label):
@@ -28,9 +604,40 @@ def list_by_label(self, project, label):
     name separated by ``/`` (e.g. ``ask/pygithub2``).
     ``label`` is a string representing a label (e.g., ``bug``).
     """
+    from github2.issues import Issue
     return self.get_values("list", project, "label", label, filter="issues",
                            datatype=Issue)
 
+def iter_by_label(self, project, label, page_size=100):
+    """Iterates over the issues of project' with label', fetching one page
+    of ``page_size`` issues at a time so that only one page is held in
+    memory.
+
+    The iteration stops at the first page that is empty, smaller than
+    ``page_size``, or identical to the previous one. Endpoints that are not
+    paginated ignore ``page`` and ``per_page`` and return all the issues in
+    one response: a page larger than ``page_size`` ends the iteration
+    without another request, but the whole response is then in memory.
+    """
+    from github2.issues import Issue
+    page = 1
+    previous = None
+    while True:
+        values = self.make_request("list", project, "label",
+                "%s?page=%d&per_page=%d" % (label, page, page_size),
+                filter="issues")
+        numbers = [value.get("number") for value in values]
+        if not values or numbers == previous:
+            return
+        for value in values:
+            yield Issue(**dict((str(k), v) for (k, v) in value.items()))
+        if len(values) != page_size:
+            return
+        # Only the numbers are kept to detect a repeated page.
+        previous = numbers
+        values = None
+        page += 1
+
 def list_labels(self, project):
     """Get all labels for project'.
 
@@ -40,35 +647,59 @@ def list_labels(self, project):
     return self.get_values("labels", project, filter="labels")
 
 def gh_init(self, username=None, api_token=None, debug=False,
-        requests_per_minute=None, access_token=None):
+        requests_per_minute=None, access_token=None, rate_limiter=None,
+        cache=None, metrics=None, transport=None):
+    from github2.request import GithubRequest
+    from github2.issues import Issues
+    from github2.users import Users
+    from github2.repositories import Repositories
+    from github2.commits import Commits
     self.debug = debug
     self.request = GithubRequest(username=username, api_token=api_token,
                                  debug=self.debug,
                                  access_token=access_token,
-                                 requests_per_minute=requests_per_minute)
+                                 requests_per_minute=requests_per_minute,
+                                 rate_limiter=rate_limiter,
+                                 cache=cache, metrics=metrics,
+                                 transport=transport)
     self.issues = Issues(self.request)
     self.users = Users(self.request)
     self.repos = Repositories(self.request)
     self.commits = Commits(self.request)
 
 def gr_init(self, username=None, api_token=None, url_prefix=None,
-            debug=False, requests_per_minute=None, access_token=None):
+            debug=False, requests_per_minute=None, access_token=None,
+            rate_limiter=None, cache=None, metrics=None, transport=None):
     """
     Make an API request.
+
+    ``rate_limiter`` is a :class:`RateLimiter` that can be shared with other
+    clients. If None, a limiter is created when ``requests_per_minute`` is
+    provided.
+
+    ``cache`` is a :class:`ResponseCache` used to store the responses of GET
+    requests.
+
+    ``metrics`` is a :class:`Metrics` recording the requests.
+
+    ``transport`` is a :class:`Transport` that can be shared with other
+    clients. If None, the client gets its own transport.
     """
     self.username = username
     self.api_token = api_token
     self.access_token = access_token
     self.url_prefix = url_prefix
     self.debug = debug
-
-    if requests_per_minute is not None:
-        self.requests_per_minute = requests_per_minute
-        self.requests_count = 0
-        self.delay = 60.0
-    else:
-        self.delay = 0
-    self.last_request = datetime.datetime(1900, 1, 1)
+    self.requests_per_minute = requests_per_minute
+
+    if rate_limiter is None and requests_per_minute is not None:
+        rate_limiter = RateLimiter(requests_per_minute, debug=debug)
+    self.rate_limiter = rate_limiter
+    self.cache = cache
+    self.metrics = metrics
+    if transport is None:
+        transport = Transport()
+    self.transport = transport
     if not self.url_prefix:
         self.url_prefix = self.url_format % {
             "github_url": self.github_url,
@@ -77,39 +708,177 @@ def gr_init(self, username=None, api_token=None, url_prefix=None,
         }
 
 def gr_make_request(self, path, extra_post_data=None, method="GET"):
-    # WARNING: THIS CODE IS NOT THREAD SAFE!!!!
-    new_round = False
-
-    if self.delay:
-        since_last = (datetime.datetime.now() - self.last_request)
-        since_last_seconds = (since_last.days * 24 * 60 * 60) + since_last.seconds + (since_last.microseconds/1000000.0)
-
-        if since_last_seconds > self.delay:
-            self.requests_count = 1
-            new_round = True
-        elif self.requests_count >= self.requests_per_minute:
-            duration = self.delay - since_last_seconds
-            if self.debug:
-                sys.stderr.write("delaying API call %s\n" % duration)
-            time.sleep(duration)
-            self.requests_count = 1
-            new_round = True
-        else:
-            self.requests_count += 1
-
+    import json
     extra_post_data = extra_post_data or {}
     url = "/".join([self.url_prefix, path])
-    result = self.raw_request(url, extra_post_data, method=method)
 
-    if self.delay and new_round:
-        self.last_request = datetime.datetime.now()
+    cache_entry = None
+    if self.cache is not None and not extra_post_data and \
+            method.upper() == "GET":
+        cache_entry = self.cache.get(self._cache_key(url))
+        if cache_entry is not None and self.cache.is_fresh(cache_entry):
+            if self.metrics is not None:
+                self.metrics.record_cache_hit(url)
+            return json.loads(cache_entry['body'])
+
+    max_wait = _max_wait()
+    if max_wait is not None and max_wait <= 0:
+        raise DeadlineExceeded()
+    if self.rate_limiter is not None:
+        slept = self.rate_limiter.acquire(max_wait)
+        if self.metrics is not None:
+            self.metrics.record_sleep(slept)
+
+    return self.raw_request(url, extra_post_data, method=method,
+            cache_entry=cache_entry)
+
+def gr_cache_key(self, url):
+    # Responses may differ from one user to another (e.g., private repos).
+    return "%s %s" % (self.username or "", url)
+
+def gr_raw_request(self, url, extra_post_data, method="GET",
+        cache_entry=None):
+    from urlparse import urlparse, urlunparse, parse_qsl
+    import json
+    scheme, netloc, path, params, query, fragment = urlparse(url)
+    post_data = None
+    headers = self.http_headers
+    headers["Accept"] = "text/html"
+    method = method.upper()
+    if extra_post_data or method == "POST":
+        post_data = self.encode_authentication_data(extra_post_data)
+        headers["Content-Length"] = str(len(post_data))
+    else:
+        path = urlunparse((scheme, netloc, path, params,
+            self.encode_authentication_data(dict(parse_qsl(query))),
+            fragment))
+    if cache_entry is not None:
+        if cache_entry.get('etag'):
+            headers["If-None-Match"] = cache_entry['etag']
+        if cache_entry.get('last_modified'):
+            headers["If-Modified-Since"] = cache_entry['last_modified']
+    connector = self.connector_for_scheme[scheme]
+    start = time.time()
+    response = self.transport.request(connector, netloc, method, path,
+            post_data, headers)
+    response_text = response.read()
+    if self.metrics is not None:
+        self.metrics.record_request(url, response.status, time.time() - start,
+                len(response_text), response.status == 304)
+
+    if self.rate_limiter is not None:
+        self.rate_limiter.update_from_headers(response.getheader)
+
+    if response.status == 304 and cache_entry is not None:
+        response_text = cache_entry['body']
+        cache_entry['stored'] = time.time()
+        self.cache.set(self._cache_key(url), cache_entry)
+        if self.debug:
+            sys.stderr.write("URL:[%s] NOT MODIFIED\n" % path)
+        return json.loads(response_text)
+
+    if self.debug:
+        sys.stderr.write("URL:[%s] POST_DATA:%s RESPONSE_TEXT: [%s]\n" % (
+                            path, post_data, response_text))
+    if response.status == 403 and \
+            response.getheader('X-RateLimit-Remaining') == '0':
+        reset = response.getheader('X-RateLimit-Reset')
+        raise QuotaExceeded(float(reset) if reset else None)
+    if response.status >= 400:
+        raise RuntimeError("unexpected response from github.com %d: %r" % (
+                           response.status, response_text))
+    result = json.loads(response_text)
+    if result.get("error"):
+        raise self.GithubError(result["error"][0]["error"])
+
+    if self.cache is not None and post_data is None:
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+        self.cache.set(self._cache_key(url), {'body': response_text,
+            'etag': etag, 'last_modified': last_modified,
+            'stored': time.time()})
+
     return result
 
-Issues.list_by_label = list_by_label
-Issues.list_labels = list_labels
-GithubRequest.__init__ = gr_init
-GithubRequest.make_request = gr_make_request
-Github.__init__ = gh_init
+_patch_lock = threading.Lock()
+_patched = False
+
+def patch_github2():
+    '''Imports github2 and applies the ghmiles patches. This is done the
+    first time a client is created with `Github` or passed to a ghmiles
+    function.'''
+    global _patched
+    with _patch_lock:
+        if _patched:
+            return
+        from github2.request import GithubRequest
+        from github2.issues import Issues
+        from github2.client import Github as GithubClient
+        Issues.list_by_label = list_by_label
+        Issues.list_labels = list_labels
+        Issues.iter_by_label = iter_by_label
+        GithubRequest.__init__ = gr_init
+        GithubRequest.make_request = gr_make_request
+        GithubRequest.raw_request = gr_raw_request
+        GithubRequest._cache_key = gr_cache_key
+        GithubClient.__init__ = gh_init
+        _patched = True
+
+def _client(github):
+    '''Returns `github`, or a new client if it is None. Clients created by
+    the caller with `github2.client.Github` work as well: github2 is patched
+    and a client created before the patch gets the ghmiles defaults.'''
+    if github is None:
+        return Github(requests_per_minute=60)
+    patch_github2()
+    request = getattr(github, 'request', None)
+    if request is not None and not hasattr(request, 'transport'):
+        request.access_token = None
+        request.requests_per_minute = None
+        request.rate_limiter = None
+        request.cache = None
+        request.metrics = None
+        request.transport = Transport()
+    return github
+
+def _github_client_class():
+    patch_github2()
+    from github2.client import Github as GithubClient
+    return GithubClient
+
+class _GithubType(type):
+    '''Metaclass making `Github` stand for `github2.client.Github` without
+    importing github2 before a client is created or Github is subclassed.'''
+
+    def __new__(mcs, name, bases, namespace):
+        if not any(isinstance(base, mcs) for base in bases):
+            return type.__new__(mcs, name, bases, namespace)
+        # Subclasses of Github are real subclasses of the github2 client.
+        bases = tuple(_github_client_class() if isinstance(base, mcs)
+                else base for base in bases)
+        return type(name, bases, namespace)
+
+    def __call__(cls, *args, **kwargs):
+        return _github_client_class()(*args, **kwargs)
+
+    def __instancecheck__(cls, instance):
+        # No client exists before github2 is imported.
+        return 'github2.client' in sys.modules and \
+                isinstance(instance, _github_client_class())
+
+    def __subclasscheck__(cls, subclass):
+        return 'github2.client' in sys.modules and \
+                issubclass(subclass, _github_client_class())
+
+class Github(object):
+    '''A `github2.client.Github` client patched by ghmiles. In addition to
+    the github2 arguments, the client accepts `requests_per_minute`,
+    `rate_limiter`, `cache`, `metrics` and `transport`.
+
+    Creating a client returns a `github2.client.Github` instance, and
+    `isinstance` and subclassing work as with the github2 class.'''
+
+    __metaclass__ = _GithubType
 
 
 #### CONSTANTS ####
@@ -126,7 +895,12 @@ MILESTONE_LABEL_V_RELAX = re.compile(r'''^v\d+(?:\.\d+)*''')
 MILESTONE_LABEL_NUM_RELAX = re.compile(r'''^\d+(?:\.\d+)*''')
 '''Regex used to identify numerical milestone labels of the form 0.1'''
 
-SIMPLE_HTML_HEADER = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
+MILESTONE_SCHEMES = [MILESTONE_LABEL_NUM, MILESTONE_LABEL_NUM_RELAX,
+        MILESTONE_LABEL_V, MILESTONE_LABEL_V_RELAX]
+'''Regexes considered by get_intel_milestone_labels, in order of preference.
+See register_milestone_scheme.'''
+
+SIMPLE_HTML_HEADER = u'''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
     "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
 <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
   <head>
@@ -137,7 +911,7 @@ SIMPLE_HTML_HEADER = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
     <h1>{0} Roadmap</h1>
 '''
 
-SIMPLE_HTML_FOOTER = '''
+SIMPLE_HTML_FOOTER = u'''
   <hr/>
   <p>
   Generated by <a href="https://github.com/bartdag/ghmiles">ghmiles</a>
@@ -151,7 +925,7 @@ SIMPLE_HTML_FOOTER = '''
   </body>
 </html>'''
 
-FANCY_HTML_HEADER = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
+FANCY_HTML_HEADER = u'''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
     "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
 <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
   <head>
@@ -246,7 +1020,7 @@ FANCY_HTML_HEADER = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
     <div id="main">
 '''
 
-FANCY_HTML_FOOTER = '''
+FANCY_HTML_FOOTER = u'''
     </div>
     <div id="ft">
     <p>
@@ -262,99 +1036,496 @@ FANCY_HTML_FOOTER = '''
   </body>
 </html>'''
 
+STALE_MARKER = u' <em class="stale">(update pending)</em>'
+'''Shown next to the title of the milestones that could not be updated'''
+
+SIMPLE_MILESTONE_TEMPLATE = u'''<h2>Milestone: {title}{stale}</h2>
+<p><strong>Progress: {progress}%</strong></p><p><em>Number of tickets: \
+closed: {closed} active: {opened} total: {total}</em></p>
+<p>Issues:</p>
+<ul>
+{issues}</ul>
+'''
+
+SIMPLE_ISSUE_TEMPLATE = u'''<li> #{number} {title} <em>{state}</em></li>
+'''
+
+FANCY_MILESTONE_TEMPLATE = u'''<a name="{title}"></a><h2>Milestone: {title}{stale}</h2>
+
+        <script type="text/javascript">
+        $(function() {{
+          $("#progressbar{anchor}").progressbar({{value: {percent} }});
+          }});
+        </script>
+        <div class="pb">
+        <div id="progressbar{anchor}"></div>
+        <div class="pb_label">{percent}%</div>
+        </div>
+        <dl class="tickets">
+          <dt>Number of tickets:</dt><dd></dd>
+          <dt>closed:</dt>
+          <dd>{closed}</dd>
+          <dt>active:</dt>
+          <dd>{opened}</dd>
+          <dt>total:</dt>
+          <dd>{total}</dd>
+        </dl>
+        <p><a href="#{title}" class="details">List of Issues:</a></p>
+<ul class="issues_list">
+{issues}</ul>
+'''
+
+FANCY_ISSUE_TEMPLATE = u'''<li><a href="https://github.com/{project}/issues/\
+{number}">#{number}</a> {title} <strong>- {state}</strong></li>
+'''
+
+SITE_MILESTONE_TEMPLATE = u'''<h2><a href="{page}">Milestone: {title}</a>{stale}</h2>
+<p><strong>Progress: {percent}%</strong> <em>closed: {closed} active: \
+{opened} total: {total}</em></p>
+'''
+
+INDEX_PROJECT_TEMPLATE = u'''<li><a href="{page}">{project}</a>: \
+{milestones} milestones, {closed} of {total} issues closed ({percent}%)</li>
+'''
+
+INDEX_ERROR_TEMPLATE = u'''<li>{project}: <em>{error}</em></li>
+'''
+
+LABEL_COMPONENT = re.compile(r'''(\d+\D*)''')
+'''Regex used to split a label into components: a number and its suffix'''
+
+LABEL_NUMBER = re.compile(r'''(\d+)(\D*)''')
+'''Regex used to split a component into its number and its suffix'''
+
+LABEL_SEPARATORS = '.-_ '
+'''Characters separating the numbers of a milestone label'''
+
+LABEL_KEY_CACHE_SIZE = 100000
+'''Maximum number of label (and component) keys memoized by label_key'''
+
+_label_keys = {}
+
+_component_keys = {}
+
+_combined_schemes = {}
+
 #### MILESTONE MODEL #####
 
+class IssueRecord(object):
+    '''Lightweight copy of a `github2.issues.Issue` keeping only the fields
+    used by the milestone model and the HTML writers.'''
+
+    __slots__ = ('number', 'title', 'state', 'labels', 'updated_at',
+            'created_at', 'closed_at')
+
+    def __init__(self, number, title, state, labels=(), updated_at=None,
+            created_at=None, closed_at=None):
+        self.number = number
+        self.title = title
+        self.state = state
+        self.labels = tuple(labels)
+        self.updated_at = updated_at
+        self.created_at = created_at
+        self.closed_at = closed_at
+
+    @classmethod
+    def from_issue(cls, issue):
+        if isinstance(issue, cls):
+            return issue
+        return cls(issue.number, issue.title, issue.state,
+                issue.labels or (), getattr(issue, 'updated_at', None),
+                getattr(issue, 'created_at', None),
+                getattr(issue, 'closed_at', None))
+
+    def __getstate__(self):
+        # Fields are pickled with their names so that snapshots do not depend
+        # on the order of the slots. The names are the same tuple for every
+        # record, so a pickle only stores them once.
+        return (self.__slots__, tuple(getattr(self, name) for name in
+            self.__slots__))
+
+    def __setstate__(self, state):
+        # Fields missing from older pickles keep a default value.
+        for name in self.__slots__:
+            setattr(self, name, None)
+        (names, values) = state
+        for (name, value) in zip(names, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "<Issue: %s>" % self.title.encode('utf-8')
+
+
 class Milestone(object):
+    '''List of issues sharing a milestone label.
+
+    By default, the issues are converted to `IssueRecord` to save memory.
+    Set `keep_issues` to True to keep the issues as provided (e.g., to
+    access the body of `github2.issues.Issue` objects).
+
+    `stale` is True if the milestone could not be fetched in time and comes
+    from an older snapshot (see `get_milestones_within`).
+    '''
+
+    __slots__ = ('title', 'issues', 'total', 'opened', 'closed', 'progress',
+            'synced_at', 'keep_issues', 'stale', '_issues_hash')
 
-    def __init__(self, title, issues):
+    def __init__(self, title, issues, keep_issues=False):
         self.title = title
+        self.keep_issues = keep_issues
+        self.stale = False
+        self._issues_hash = None
+        # issues can be a lazy iterator (e.g., pages streamed by
+        # iter_by_label): each issue is converted as it arrives so that only
+        # the records are kept, and the records are only sorted if they
+        # arrived out of order.
+        if keep_issues:
+            issues = list(issues)
+        else:
+            from_issue = IssueRecord.from_issue
+            issues = [from_issue(issue) for issue in issues]
+        numbers = [int(issue.number) for issue in issues]
+        if numbers != sorted(numbers):
+            issues.sort(key=lambda item: int(item.number))
         self.issues = issues
-        self.issues.sort(key=lambda item: int(item.number))
         self.total = len(issues)
-        self.opened = sum((1 for issue in issues if issue.state == 'open'))
+        self.opened = [issue.state for issue in issues].count('open')
+        self.synced_at = _last_update(issues)
+        self._compute_progress()
+
+    def _compute_progress(self):
         self.closed = self.total - self.opened
-        self.progress = float(self.closed) * 100.0 / float(self.total)
+        if self.total:
+            self.progress = float(self.closed) * 100.0 / float(self.total)
+        else:
+            self.progress = 0.0
+
+    @property
+    def completed(self):
+        '''True if the milestone has issues and all of them are closed.'''
+        return self.total > 0 and self.opened == 0
+
+    def update(self, issues):
+        '''Patches the milestone with issues that changed since it was built.
+        Issues that are no longer labeled with the milestone title are
+        removed and new ones are inserted in order.
+
+        :param issues: an iterable of issues. Issues unrelated to the
+               milestone are ignored.
+        '''
+        numbers = [int(issue.number) for issue in self.issues]
+        updates = []
+        for issue in issues:
+            if not self.keep_issues:
+                issue = IssueRecord.from_issue(issue)
+            number = int(issue.number)
+            index = bisect.bisect_left(numbers, number)
+            present = index < len(numbers) and numbers[index] == number
+            labeled = self.title in issue.labels
+            if present:
+                if self.issues[index].state == 'open':
+                    self.opened -= 1
+                if labeled:
+                    self.issues[index] = issue
+                else:
+                    del self.issues[index]
+                    del numbers[index]
+            elif labeled:
+                self.issues.insert(index, issue)
+                numbers.insert(index, number)
+            else:
+                continue
+            if labeled and issue.state == 'open':
+                self.opened += 1
+            updates.append(issue)
+
+        self.total = len(self.issues)
+        self._issues_hash = None
+        last_update = _last_update(updates)
+        if self.synced_at is None or (last_update is not None and
+                last_update > self.synced_at):
+            self.synced_at = last_update
+        self._compute_progress()
+
+    def content_hash(self):
+        '''Returns a hash of the milestone title and of the number, title
+        and state of its issues (and of its stale flag). Two milestones with
+        the same hash render the same roadmap.
+
+        The hash of the issues is computed once and reset by `update`. Call
+        `update` (or build a new milestone) after modifying `issues`.'''
+        import hashlib
+        if self._issues_hash is None:
+            digest = hashlib.sha1()
+            digest.update(_utf8(self.title))
+            # One update for all the issues is faster than one per issue.
+            digest.update(_utf8(u''.join([u'\0%s\0%s\0%s' % (
+                issue.number, issue.title, issue.state)
+                for issue in self.issues])))
+            self._issues_hash = digest.hexdigest()
+        if self.stale:
+            return hashlib.sha1(_utf8(self._issues_hash + u'\0stale')
+                    ).hexdigest()
+        return self._issues_hash
+
+    def __getstate__(self):
+        # Pickled with the names of the fields, as IssueRecord.
+        return (self.__slots__, tuple(getattr(self, name) for name in
+            self.__slots__))
+
+    def __setstate__(self, state):
+        # Fields missing from older pickles keep a default value.
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.keep_issues = False
+        self.stale = False
+        (names, values) = state
+        for (name, value) in zip(names, values):
+            setattr(self, name, value)
 
     def __repr__(self):
         return '<Milestone: {0}, {1} issues, {2:.2f}% completed>'.format(
                 self.title, self.total, self.progress)
 
-def label_key(label, padding=5):
-    '''Returns a padded key from a label representing a milestone number.
-    All parts of a label that are numbers are padded so that alphabetical
-    sorting can work as expected (e.g., '2.0' < '11.0'). 
+def milestones_hash(milestones):
+    '''Returns a hash of the content and order of a list of milestones.'''
+    return _combine_hashes(milestone.content_hash() for milestone in
+            milestones)
+
+def _combine_hashes(hashes):
+    import hashlib
+    digest = hashlib.sha1()
+    for content_hash in hashes:
+        digest.update(content_hash)
+    return digest.hexdigest()
+
+def _utf8(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+def _text(text):
+    if isinstance(text, bytes):
+        return text.decode('utf-8')
+    return text
+
+def _last_update(issues):
+    dates = [issue.updated_at for issue in issues
+            if getattr(issue, 'updated_at', None) is not None]
+    if dates:
+        return max(dates)
+    else:
+        return None
+
+def label_key(label, padding=None):
+    '''Returns a key from a label representing a milestone number.
+    The key is a tuple starting with the prefix of the label (the characters
+    before the first number) followed by each number, the rank of its suffix
+    and the suffix itself so that numbers are compared numerically (e.g.,
+    '2.0' < '11.0').
+
+    A suffix that is not a separator marks a pre-release that sorts before
+    the release (e.g., 'v1.0rc1' < 'v1.0' < 'v1.0.1').
 
-    For example, this function will return 'v00001.00022e-00123b' if label =
-    'v1.22e-123b'.
+    Keys are memoized because labels are sorted every time they are listed.
+    The keys of components (e.g., '1.') are memoized too because they repeat
+    across the labels of a project.
 
     :param label: the milestone label
-    :param padding: the maximum number of characters for each numeric part.
-           Default=5
-    :return: a key that can be used in alphabetical sorting
-    '''
-    key = prefix = ''
-    components = []
-   
-    in_prefix = True
-    current_number = current_suffix = ''
-
-    for c in label:
-        if not c.isdigit():
-            if in_prefix:
-                prefix += c
-            else:
-                current_suffix += c
-        else:
-            if in_prefix:
-                in_prefix = False
-            if current_suffix != '':
-                components.append((current_number, current_suffix))
-                current_number = current_suffix = ''
-            current_number += c
+    :param padding: ignored. Numbers of any size are compared numerically.
+    :return: a key that can be used in sorting
+    '''
+    key = _label_keys.get(label)
+    if key is not None:
+        return key
 
-    if not in_prefix and current_number != '':
-        components.append((current_number, current_suffix))
+    parts = LABEL_COMPONENT.split(label)
+    key = (parts[0],)
+    for component in parts[1::2]:
+        key += _component_keys.get(component) or _component_key(component)
 
-    key = prefix
-    for component in components:
-        key += component[0].rjust(padding,'0') + component[1]
+    if len(_label_keys) >= LABEL_KEY_CACHE_SIZE:
+        _label_keys.clear()
+        _component_keys.clear()
+    _label_keys[label] = key
 
     return key
 
+def _component_key(component):
+    suffix = component.lstrip('0123456789')
+    number = int(component[:len(component) - len(suffix)])
+    text = suffix.strip(LABEL_SEPARATORS)
+    if suffix == '':
+        # End of the label
+        key = (number, 1, text)
+    elif text == '':
+        # Another number follows
+        key = (number, 2, text)
+    else:
+        # Pre-release
+        key = (number, 0, text.lower())
+    if len(_component_keys) < LABEL_KEY_CACHE_SIZE:
+        _component_keys[component] = key
+    return key
+
 def get_milestone_labels(project, milestone_regex, reverse=True, github=None):
-    if github is None:
-        github = Github(requests_per_minute=60)
-    labels = sorted(github.issues.list_labels(project), key=label_key, reverse=reverse)
+    github = _client(github)
+    with _phase(github, 'labels'):
+        labels = github.issues.list_labels(project)
+    labels = sorted(labels, key=label_key, reverse=reverse)
     project_labels = (label for label in labels if milestone_regex.match(label))
     return project_labels
 
-def get_intel_milestone_labels(project, reverse=True, github=None):
-    if github is None:
-        github = Github(requests_per_minute=60)
-    labels = sorted(github.issues.list_labels(project), key=label_key, reverse=reverse)
-    regexes = [MILESTONE_LABEL_NUM, MILESTONE_LABEL_NUM_RELAX,
-            MILESTONE_LABEL_V, MILESTONE_LABEL_V_RELAX]
-    max_labels = 0
-    limit = len(labels)
-    project_labels = []
-    for regex in regexes:
-        temp_labels = [label for label in labels if regex.match(label)]
-        size = len(temp_labels)
-        if size > max_labels:
-            project_labels = temp_labels
-            max_labels = size
-        if size == limit:
-            break
+def get_intel_milestone_labels(project, reverse=True, github=None,
+        schemes=None):
+    '''Finds the labels representing milestones by using the scheme (a
+    regular expression) that matches the most labels of the project.
+
+    :param project: a string of the form `user/project`
+    :param reverse: If True (default), sort the milestone labels from the
+           highest number to the lowest. Oppositive if False.
+    :param github: a Github client (optional).
+    :param schemes: the list of regexes to consider. Defaults to
+           `MILESTONE_SCHEMES`. (optional)
+    :return: A tuple (milestone labels, labels). Only the milestone labels
+           are sorted; the labels are in the order returned by GitHub.
+    '''
+    github = _client(github)
+    with _phase(github, 'labels'):
+        labels = github.issues.list_labels(project)
+    (_, project_labels) = classify_milestone_labels(labels, schemes)
+    project_labels.sort(key=label_key, reverse=reverse)
 
     return (project_labels, labels)
 
-def get_milestone(project, milestone_label, github=None):
-    if github is None:
-        github = Github(requests_per_minute=60)
-    issues = github.issues.list_by_label(project, milestone_label)
-    return Milestone(milestone_label, issues)
+def classify_milestone_labels(labels, schemes=None):
+    '''Finds the milestone scheme matching the most labels. When several
+    schemes match the same number of labels, the first one wins.
+
+    The labels are scanned once: labels that do not match any scheme are
+    discarded with a single regex combining all the schemes.
+
+    :param labels: an iterable of labels.
+    :param schemes: the list of regexes to consider. Defaults to
+           `MILESTONE_SCHEMES`. (optional)
+    :return: A tuple (scheme, matching labels). The scheme is None if there
+           is no scheme.
+    '''
+    if schemes is None:
+        schemes = MILESTONE_SCHEMES
+    if not schemes:
+        return (None, [])
+
+    combined = _combine_schemes(tuple(schemes))
+    matches = [[] for _ in schemes]
+    for label in labels:
+        if combined is not None and not combined.match(label):
+            continue
+        for (index, regex) in enumerate(schemes):
+            if regex.match(label):
+                matches[index].append(label)
+
+    best = 0
+    for index in range(1, len(schemes)):
+        if len(matches[index]) > len(matches[best]):
+            best = index
+
+    return (schemes[best], matches[best])
+
+def register_milestone_scheme(regex, schemes=None):
+    '''Adds a regex to the schemes considered by
+    `get_intel_milestone_labels` (e.g., `^release-\\d+(?:\\.\\d+)*$`). The
+    new scheme has the lowest preference.
+
+    :param regex: a regular expression (compiled or not).
+    :param schemes: the list of regexes to extend. Defaults to
+           `MILESTONE_SCHEMES`. (optional)
+    :return: The compiled regular expression.
+    '''
+    if schemes is None:
+        schemes = MILESTONE_SCHEMES
+    if isinstance(regex, basestring):
+        regex = re.compile(regex)
+    schemes.append(regex)
+    return regex
+
+def _combine_schemes(schemes):
+    try:
+        return _combined_schemes[schemes]
+    except KeyError:
+        pass
+
+    combined = None
+    flags = set(regex.flags for regex in schemes)
+    if len(flags) == 1:
+        try:
+            combined = re.compile('|'.join('(?:{0})'.format(regex.pattern)
+                for regex in schemes), flags.pop())
+        except re.error:
+            # e.g., group names used by several schemes
+            combined = None
+
+    if len(_combined_schemes) >= 100:
+        _combined_schemes.clear()
+    _combined_schemes[schemes] = combined
+
+    return combined
+
+def get_milestone(project, milestone_label, github=None, keep_issues=False,
+        page_size=None):
+    github = _client(github)
+    if page_size is not None:
+        # The pages are fetched while the milestone consumes the issues.
+        with _phase(github, 'milestone'):
+            return Milestone(milestone_label, github.issues.iter_by_label(
+                project, milestone_label, page_size), keep_issues)
+    with _phase(github, 'milestone'):
+        issues = github.issues.list_by_label(project, milestone_label)
+    return Milestone(milestone_label, issues, keep_issues)
+
+def get_issues(project, github=None):
+    '''Returns all the issues (open and closed) of a github project.
+
+    :param project: a string of the form `user/project`
+    :param github: a Github client (optional).
+    :return: A list of issues.
+    '''
+    github = _client(github)
+    with _phase(github, 'issues'):
+        return (github.issues.list(project, 'open') +
+                github.issues.list(project, 'closed'))
 
-def get_milestones(project, milestone_regex, reverse=True, github=None):
+def index_issues_by_label(issues, labels=None):
+    '''Returns a dict mapping each label to the list of issues having this
+    label.
+
+    :param issues: an iterable of issues.
+    :param labels: if provided, only these labels are indexed. (optional)
+    '''
+    if labels is not None:
+        labels = set(labels)
+    index = {}
+    for issue in issues:
+        for label in issue.labels:
+            if labels is None or label in labels:
+                index.setdefault(label, []).append(issue)
+    return index
+
+def get_milestones_from_index(labels, index, keep_issues=False):
+    '''Generates a list of milestones from an index built by
+    `index_issues_by_label`.
+
+    :param labels: a list of labels used to generate milestones.
+    :param index: a dict mapping labels to lists of issues.
+    :param keep_issues: if True, the milestones keep the full issue objects
+           instead of `IssueRecord`. (optional)
+    :return: A generator (iterator) of milestones.
+    '''
+    return (Milestone(label, list(index.get(label, ())), keep_issues)
+            for label in labels)
+
+def get_milestones(project, milestone_regex, reverse=True, github=None,
+        workers=None, bulk=False, keep_issues=False, page_size=None):
     '''Generates a list of milestones for a github project
 
     :param project: a string of the form `user/project`
@@ -363,18 +1534,26 @@ def get_milestones(project, milestone_regex, reverse=True, github=None):
     :param reverse: If True (default), sort the milestones from the highest 
            number to the lowest. Oppositive if False.
     :param github: a Github client (optional).
+    :param workers: if greater than 1, the number of threads used to fetch
+           the milestones concurrently. (optional)
+    :param bulk: if True, all the issues of the project are fetched at once
+           instead of making one request per milestone. (optional)
+    :param keep_issues: if True, the milestones keep the full issue objects
+           instead of `IssueRecord`. (optional)
+    :param page_size: if provided, the issues of each milestone are streamed
+           in pages of page_size issues instead of being fetched in a single
+           list. Ignored if bulk is True. (optional)
     :return: A generator (iterator) of milestones. 
     '''
 
-    if github is None:
-        github = Github(requests_per_minute=60)
+    github = _client(github)
     labels = get_milestone_labels(project, milestone_regex, reverse, github)
-    milestones = (get_milestone(project, label, github) for
-        label in labels) 
 
-    return milestones
+    return _fetch_milestones(project, labels, github, workers, bulk,
+            keep_issues, page_size)
 
-def get_milestones_from_labels(project, labels, github=None):
+def get_milestones_from_labels(project, labels, github=None, workers=None,
+        bulk=False, keep_issues=False, page_size=None):
     '''Generates a list of milestones from the specified issue labels of a 
     github project. This can be used to generate a milestone model for recent
     milestones only.
@@ -382,111 +1561,1073 @@ def get_milestones_from_labels(project, labels, github=None):
     :param project: a string of the form `user/project`
     :param labels: a list of labels used to generate milestones. 
     :param github: a Github client (optional).
+    :param workers: if greater than 1, the number of threads used to fetch
+           the milestones concurrently. (optional)
+    :param bulk: if True, all the issues of the project are fetched at once
+           instead of making one request per milestone. (optional)
+    :param keep_issues: if True, the milestones keep the full issue objects
+           instead of `IssueRecord`. (optional)
+    :param page_size: if provided, the issues of each milestone are streamed
+           in pages of page_size issues instead of being fetched in a single
+           list. Ignored if bulk is True. (optional)
     :return: A generator (iterator) of milestones. 
     '''
-    if github is None:
-        github = Github(requests_per_minute=60)
-    milestones = (get_milestone(project, label, github) for
-        label in labels) 
+    github = _client(github)
+
+    return _fetch_milestones(project, labels, github, workers, bulk,
+            keep_issues, page_size)
+
+def refresh_milestones(project, milestones, github=None,
+        refresh_completed=False):
+    '''Updates milestones previously built for a github project with the
+    issues modified since the milestones were last synchronized. The
+    milestones are patched in place.
+
+    :param project: a string of the form `user/project`
+    :param milestones: a list (or iterator) of milestones.
+    :param github: a Github client (optional).
+    :param refresh_completed: if False (default), milestones whose issues are
+           all closed are considered frozen and are not updated. If no other
+           milestone needs to be updated, no request is made.
+    :return: The list of milestones.
+    '''
+    milestones = list(milestones)
+    active = [milestone for milestone in milestones
+            if refresh_completed or not milestone.completed]
+    if not active:
+        return milestones
+
+    github = _client(github)
+
+    issues = get_issues(project, github)
+    if any(milestone.synced_at is None for milestone in active):
+        changed = issues
+    else:
+        since = min(milestone.synced_at for milestone in active)
+        changed = [issue for issue in issues if issue.updated_at is None or
+                issue.updated_at >= since]
+
+    for milestone in active:
+        milestone.update(changed)
 
     return milestones
 
+MILESTONE_ADDED = 'milestone_added'
+MILESTONE_REMOVED = 'milestone_removed'
+ISSUE_ADDED = 'issue_added'
+ISSUE_REMOVED = 'issue_removed'
+ISSUE_STATE_CHANGED = 'issue_state_changed'
+ISSUE_TITLE_CHANGED = 'issue_title_changed'
+PROGRESS_CHANGED = 'progress_changed'
+
+
+class MilestoneEvent(object):
+    '''A change between two versions of a milestone, reported by
+    `diff_milestones`.
+
+    `kind` is one of the `MILESTONE_*`, `ISSUE_*` and `PROGRESS_CHANGED`
+    constants and `milestone` is the title of the milestone. Issue events
+    have an `issue` (the new issue, or the old one if it was removed). State,
+    title and progress changes have the `old` and `new` values.
+    '''
+
+    __slots__ = ('kind', 'milestone', 'issue', 'old', 'new')
+
+    def __init__(self, kind, milestone, issue=None, old=None, new=None):
+        self.kind = kind
+        self.milestone = milestone
+        self.issue = issue
+        self.old = old
+        self.new = new
+
+    def describe(self):
+        '''Returns a short human-readable description of the event.'''
+        if self.kind == MILESTONE_ADDED:
+            return u'{0}: new milestone'.format(self.milestone)
+        elif self.kind == MILESTONE_REMOVED:
+            return u'{0}: milestone removed'.format(self.milestone)
+        elif self.kind == PROGRESS_CHANGED:
+            return u'{0}: progress {1:.0f}% -> {2:.0f}%'.format(
+                    self.milestone, self.old, self.new)
+        elif self.kind == ISSUE_STATE_CHANGED:
+            return u'{0}: #{1} {2} -> {3}'.format(self.milestone,
+                    self.issue.number, self.old, self.new)
+        elif self.kind == ISSUE_TITLE_CHANGED:
+            return u'{0}: #{1} renamed to {2}'.format(self.milestone,
+                    self.issue.number, self.new)
+        verb = 'added' if self.kind == ISSUE_ADDED else 'removed'
+        return u'{0}: #{1} {2} ({3})'.format(self.milestone,
+                self.issue.number, verb, self.issue.title)
+
+    def __repr__(self):
+        return '<MilestoneEvent: {0} {1}>'.format(self.kind,
+                _utf8(self.milestone))
+
+def diff_milestones(old_milestones, new_milestones):
+    '''Compares two versions of the milestones of a project, e.g., the
+    milestones of the previous and of the current build.
+
+    Milestones with the same content hash are skipped without looking at
+    their issues (the hash of a milestone is only computed once). The
+    issues of the other milestones are compared in a single pass since they
+    are sorted by number.
+
+    :param old_milestones: a list (or iterator) of milestones.
+    :param new_milestones: a list (or iterator) of milestones.
+    :return: A list of `MilestoneEvent`: the events of the new milestones,
+             in their order, then the removed milestones.
+    '''
+    old_by_title = dict((milestone.title, milestone) for milestone in
+            old_milestones)
+    events = []
+    titles = set()
+    for milestone in new_milestones:
+        titles.add(milestone.title)
+        old = old_by_title.get(milestone.title)
+        if old is None:
+            events.append(MilestoneEvent(MILESTONE_ADDED, milestone.title))
+        elif old.content_hash() != milestone.content_hash():
+            events.extend(_diff_issues(old, milestone))
+    for (title, milestone) in old_by_title.items():
+        if title not in titles:
+            events.append(MilestoneEvent(MILESTONE_REMOVED, title))
+    return events
+
+def _diff_issues(old, new):
+    events = []
+    title = new.title
+    old_issues = old.issues
+    new_issues = new.issues
+    (i, j) = (0, 0)
+    while i < len(old_issues) or j < len(new_issues):
+        old_number = int(old_issues[i].number) if i < len(old_issues) \
+                else None
+        new_number = int(new_issues[j].number) if j < len(new_issues) \
+                else None
+        if new_number is None or (old_number is not None and
+                old_number < new_number):
+            events.append(MilestoneEvent(ISSUE_REMOVED, title,
+                old_issues[i]))
+            i += 1
+        elif old_number is None or new_number < old_number:
+            events.append(MilestoneEvent(ISSUE_ADDED, title, new_issues[j]))
+            j += 1
+        else:
+            (old_issue, new_issue) = (old_issues[i], new_issues[j])
+            if old_issue.state != new_issue.state:
+                events.append(MilestoneEvent(ISSUE_STATE_CHANGED, title,
+                    new_issue, old_issue.state, new_issue.state))
+            if old_issue.title != new_issue.title:
+                events.append(MilestoneEvent(ISSUE_TITLE_CHANGED, title,
+                    new_issue, old_issue.title, new_issue.title))
+            i += 1
+            j += 1
+    if old.progress != new.progress:
+        events.append(MilestoneEvent(PROGRESS_CHANGED, title, old=old.progress,
+            new=new.progress))
+    return events
+
+def save_snapshot(milestones, path):
+    '''Saves milestones to a file so that they can be refreshed later with
+    `refresh_milestones`.
+
+    :param milestones: a list (or iterator) of milestones.
+    :param path: the path of the snapshot file.
+    '''
+    write_file_atomically(path,
+            pickle.dumps(list(milestones), pickle.HIGHEST_PROTOCOL), 'wb')
+
+def load_snapshot(path):
+    '''Loads milestones saved with `save_snapshot`.
+
+    :param path: the path of the snapshot file.
+    :return: A list of milestones.
+    '''
+    with open(path, 'rb') as snapshot_file:
+        return pickle.load(snapshot_file)
+
+def get_milestones_within(project, budget, snapshot=(), github=None,
+        milestone_regex=None, reverse=True):
+    '''Fetches the milestones of a project for at most `budget` seconds,
+    e.g., to answer a request in time when the rate limit is reached.
+
+    Milestones that cannot be fetched before the deadline (because the rate
+    limiter would make the request wait past it, or because GitHub reports
+    an exhausted quota) are copied from `snapshot` and marked as `stale`;
+    the snapshot itself is not modified. Responses still fresh in the cache
+    of the client are used even after the deadline. The milestones that were stale in the
+    snapshot or absent from it are fetched first, so that calling again
+    with the returned milestones finishes the pending ones.
+
+    :param project: a string of the form `user/project`
+    :param budget: the time budget in seconds.
+    :param snapshot: the milestones of a previous build. (optional)
+    :param github: a Github client (optional).
+    :param milestone_regex: a regular expression used to identify the labels
+           representing milestones. If None, the labels are identified with
+           `get_intel_milestone_labels`. (optional)
+    :param reverse: If True (default), sort the milestones from the highest
+           number to the lowest. Oppositive if False.
+    :return: A tuple (milestones, pending). The milestones are in the order
+             of the labels and pending lists the titles of the stale ones.
+             An unknown milestone that could not be fetched is empty.
+    '''
+    github = _client(github)
+    snapshot = list(snapshot)
+    previous = dict((milestone.title, milestone) for milestone in snapshot)
+
+    _deadlines.deadline = time.time() + budget
+    try:
+        try:
+            if milestone_regex is None:
+                (labels, _) = get_intel_milestone_labels(project, reverse,
+                        github)
+            else:
+                labels = list(get_milestone_labels(project, milestone_regex,
+                    reverse, github))
+        except (DeadlineExceeded, QuotaExceeded):
+            labels = [milestone.title for milestone in snapshot]
+
+        def priority(label):
+            milestone = previous.get(label)
+            return milestone is not None and not milestone.stale
+
+        fetched = {}
+        for label in sorted(labels, key=priority):
+            try:
+                fetched[label] = get_milestone(project, label, github)
+            except (DeadlineExceeded, QuotaExceeded):
+                pass
+    finally:
+        _deadlines.deadline = None
+
+    milestones = []
+    pending = []
+    for label in labels:
+        milestone = fetched.get(label)
+        if milestone is None:
+            milestone = previous.get(label)
+            if milestone is None:
+                milestone = Milestone(label, [])
+            else:
+                # The milestones of the snapshot belong to the caller.
+                import copy
+                milestone = copy.copy(milestone)
+                milestone.issues = list(milestone.issues)
+            milestone.stale = True
+            pending.append(label)
+        milestones.append(milestone)
+
+    return (milestones, pending)
+
+def _fetch_milestones(project, labels, github, workers, bulk, keep_issues,
+        page_size=None):
+    if bulk:
+        labels = list(labels)
+        index = index_issues_by_label(get_issues(project, github), labels)
+        return get_milestones_from_index(labels, index, keep_issues)
+    elif workers is None or workers < 2:
+        return (get_milestone(project, label, github, keep_issues,
+            page_size) for label in labels)
+    else:
+        return _fetch_milestones_concurrently(project, list(labels), github,
+                workers, keep_issues, page_size)
+
+def _fetch_milestones_concurrently(project, labels, github, workers,
+        keep_issues, page_size=None):
+    from multiprocessing.pool import ThreadPool
+    if not labels:
+        return
+    pool = ThreadPool(min(workers, len(labels)))
+    try:
+        # imap yields the milestones in the order of the labels even if they
+        # are fetched out of order.
+        for milestone in pool.imap(
+                lambda label: get_milestone(project, label, github,
+                    keep_issues, page_size), labels):
+            yield milestone
+    finally:
+        pool.terminate()
+
+
+#### PROGRESS HISTORY ####
+
+class ProgressRun(object):
+    '''Counts of a milestone that did not change between two snapshots.
+
+    `start` and `end` are the times (seconds since the epoch) of the first
+    and of the last snapshot of the run.
+    '''
+
+    __slots__ = ('start', 'end', 'total', 'opened')
+
+    def __init__(self, start, end, total, opened):
+        self.start = start
+        self.end = end
+        self.total = total
+        self.opened = opened
+
+    @property
+    def closed(self):
+        return self.total - self.opened
+
+    @property
+    def progress(self):
+        if self.total:
+            return float(self.closed) * 100.0 / float(self.total)
+        else:
+            return 0.0
+
+    def __repr__(self):
+        return '<ProgressRun: {0}-{1} {2}/{3}>'.format(self.start, self.end,
+                self.closed, self.total)
+
+
+class ProgressStore(object):
+    '''SQLite store recording the total, opened and closed counts of
+    milestones each time they are built, e.g., to draw burndown charts.
+
+    Snapshots are run-length encoded: a row is only added when the counts of
+    a milestone change, otherwise the end of its last run is moved. Years of
+    hourly snapshots thus take one row per change instead of one row per
+    snapshot.
+
+    :param path: the path of the database file, or `:memory:`.
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            # The primary key is the index used by the queries by project,
+            # label and time range.
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS progress (
+                project TEXT NOT NULL, label TEXT NOT NULL,
+                start INTEGER NOT NULL, end INTEGER NOT NULL,
+                total INTEGER NOT NULL, opened INTEGER NOT NULL,
+                PRIMARY KEY (project, label, start))''')
+
+    def record(self, project, milestones, taken_at=None):
+        '''Records the counts of milestones in a single transaction.
+
+        :param project: a string of the form `user/project`
+        :param milestones: a list (or iterator) of milestones.
+        :param taken_at: the time of the snapshot in seconds since the
+               epoch. Defaults to now. Snapshots older than the last one
+               recorded for a milestone are ignored. (optional)
+        '''
+        if taken_at is None:
+            taken_at = time.time()
+        taken_at = int(taken_at)
+        with self.lock:
+            with self.connection:
+                for milestone in milestones:
+                    self._record(project, milestone, taken_at)
+
+    def _record(self, project, milestone, taken_at):
+        execute = self.connection.execute
+        last = execute('''SELECT start, end, total, opened FROM progress
+                WHERE project = ? AND label = ? ORDER BY start DESC
+                LIMIT 1''', (project, milestone.title)).fetchone()
+        if last is not None:
+            (start, end, total, opened) = last
+            if taken_at < end:
+                return
+            if (total, opened) == (milestone.total, milestone.opened):
+                execute('''UPDATE progress SET end = ? WHERE project = ? AND
+                        label = ? AND start = ?''',
+                        (taken_at, project, milestone.title, start))
+                return
+        # Replaces a run started at the same second: the last snapshot wins.
+        execute('''INSERT OR REPLACE INTO progress VALUES
+                (?, ?, ?, ?, ?, ?)''', (project, milestone.title, taken_at,
+                    taken_at, milestone.total, milestone.opened))
+
+    def history(self, project, label, start=None, end=None):
+        '''Returns the runs of a milestone overlapping a time range.
+
+        :param project: a string of the form `user/project`
+        :param label: the title of the milestone.
+        :param start: the beginning of the range in seconds since the epoch.
+               (optional)
+        :param end: the end of the range in seconds since the epoch.
+               (optional)
+        :return: A list of `ProgressRun` sorted by time.
+        '''
+        query = '''SELECT start, end, total, opened FROM progress
+                WHERE project = ? AND label = ?'''
+        parameters = [project, label]
+        if start is not None:
+            query += ' AND end >= ?'
+            parameters.append(int(start))
+        if end is not None:
+            query += ' AND start <= ?'
+            parameters.append(int(end))
+        query += ' ORDER BY start'
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        return [ProgressRun(*row) for row in rows]
+
+    def labels(self, project):
+        '''Returns the titles of the milestones recorded for a project.'''
+        with self.lock:
+            rows = self.connection.execute('''SELECT DISTINCT label FROM
+                    progress WHERE project = ?''', (project,)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+#### STATISTICS ####
+
+WEEK_SECONDS = 7 * 24 * 3600
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+NAT = -2 ** 63
+'''Integer value of a NaT (missing) datetime64'''
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('ghmiles statistics require NumPy. Install it '
+                'with: pip install ghmiles[stats]')
+    return numpy
+
+
+class Rollup(object):
+    '''Counts of the issues of a group (a project or a milestone).'''
+
+    __slots__ = ('total', 'opened')
+
+    def __init__(self, total, opened):
+        self.total = total
+        self.opened = opened
+
+    @property
+    def closed(self):
+        return self.total - self.opened
+
+    @property
+    def progress(self):
+        if self.total:
+            return float(self.closed) * 100.0 / float(self.total)
+        else:
+            return 0.0
+
+    def __repr__(self):
+        return '<Rollup: {0}/{1}>'.format(self.closed, self.total)
+
+
+class IssueTable(object):
+    '''Columnar copy of the state of the issues of many milestones, possibly
+    of several projects, used to compute statistics in batch with NumPy.
+
+    Each row is an issue of a milestone: `project` and `milestone` are codes
+    indexing `projects` and `milestones` (pairs of project and title),
+    `number` is the issue number, `opened` is True for open issues, and
+    `created_at` and `closed_at` are `datetime64[s]` columns (NaT when
+    unknown). An issue labeled with several milestones has several rows but
+    is counted once per project.
+
+    Statistics are grouped `by` 'project' (keys are projects) or by
+    'milestone' (keys are (project, title) pairs). Dates are naive, like
+    the dates of github2.
+
+    NumPy is required: pip install ghmiles[stats]
+    '''
+
+    def __init__(self, projects, milestones, project, milestone, number,
+            opened, created_at, closed_at):
+        self.projects = projects
+        self.milestones = milestones
+        self.project = project
+        self.milestone = milestone
+        self.number = number
+        self.opened = opened
+        self.created_at = created_at
+        self.closed_at = closed_at
+        self._project_rows = None
+
+    @classmethod
+    def from_milestones(cls, roadmaps):
+        '''Builds a table from the milestones of several projects.
+
+        :param roadmaps: a dict mapping projects to lists of milestones, or
+               an iterable of (project, milestones) pairs.
+        :return: An `IssueTable`.
+        '''
+        numpy = _import_numpy()
+        if hasattr(roadmaps, 'items'):
+            roadmaps = roadmaps.items()
+        projects = []
+        milestones = []
+        milestone_projects = []
+        sizes = []
+        numbers = []
+        states = []
+        created = []
+        closed = []
+        for (project, project_milestones) in roadmaps:
+            project_code = len(projects)
+            projects.append(project)
+            for milestone in project_milestones:
+                issues = milestone.issues
+                milestones.append((project, milestone.title))
+                milestone_projects.append(project_code)
+                sizes.append(len(issues))
+                numbers.extend([issue.number for issue in issues])
+                states.extend([issue.state for issue in issues])
+                created.extend([getattr(issue, 'created_at', None)
+                    for issue in issues])
+                closed.extend([getattr(issue, 'closed_at', None)
+                    for issue in issues])
+
+        milestone = numpy.repeat(numpy.arange(len(milestones)), sizes)
+        project = numpy.array(milestone_projects, dtype='int64')[milestone]
+        # Comparing an empty string array with 'open' returns a scalar.
+        opened = numpy.array([state == 'open' for state in states],
+                dtype=bool)
+        return cls(projects, milestones, project, milestone,
+                numpy.array(numbers, dtype='int64'), opened,
+                _datetime_column(numpy, created),
+                _datetime_column(numpy, closed))
+
+    def __len__(self):
+        return len(self.number)
+
+    def _group(self, by):
+        '''Returns the group codes, the group keys and the rows to consider
+        (an issue is only counted once per project).'''
+        numpy = _import_numpy()
+        if by == 'milestone':
+            return (self.milestone, self.milestones, slice(None))
+        elif by != 'project':
+            raise ValueError('Unknown group {0!r}: use project or '
+                    'milestone'.format(by))
+        if self._project_rows is None:
+            if len(self.number):
+                key = self.project * (int(self.number.max()) + 1) + \
+                        self.number
+                (_, rows) = numpy.unique(key, return_index=True)
+            else:
+                rows = numpy.arange(0)
+            self._project_rows = rows
+        return (self.project, self.projects, self._project_rows)
+
+    def rollup(self, by='milestone'):
+        '''Returns a dict mapping each group to a `Rollup`.'''
+        numpy = _import_numpy()
+        (codes, keys, rows) = self._group(by)
+        codes = codes[rows]
+        totals = numpy.bincount(codes, minlength=len(keys))
+        opened = numpy.bincount(codes[self.opened[rows]], minlength=len(keys))
+        return dict((key, Rollup(int(total), int(open_count))) for
+                (key, total, open_count) in zip(keys, totals, opened))
+
+    def closed_per_week(self, by='project', start=None, end=None):
+        '''Counts the issues closed each week.
+
+        :param by: 'project' or 'milestone'.
+        :param start: the first week starts at this datetime. Defaults to
+               the first closing date. (optional)
+        :param end: closings after this datetime are ignored. Defaults to
+               the last closing date. (optional)
+        :return: A tuple (weeks, counts). weeks is a `datetime64[s]` array
+                 of the beginning of each week and counts is a dict mapping
+                 each group to an array of closings per week.
+        '''
+        numpy = _import_numpy()
+        (codes, keys, rows) = self._group(by)
+        (codes, seconds) = self._closings(codes, rows)
+        if start is None:
+            start = seconds.min() if len(seconds) else 0
+        else:
+            start = _epoch_seconds(numpy, start)
+        if end is None:
+            end = seconds.max() if len(seconds) else start
+        else:
+            end = _epoch_seconds(numpy, end)
+        selected = (seconds >= start) & (seconds <= end)
+        week = (seconds[selected] - start) // WEEK_SECONDS
+        week_count = max(int((end - start) // WEEK_SECONDS) + 1, 1)
+        counts = numpy.bincount(codes[selected] * week_count + week,
+                minlength=len(keys) * week_count).reshape(len(keys),
+                        week_count)
+        weeks = (start + numpy.arange(week_count) * WEEK_SECONDS).astype(
+                'datetime64[s]')
+        return (weeks, dict(zip(keys, counts)))
+
+    def velocity(self, by='project', weeks=4, now=None):
+        '''Returns a dict mapping each group to its average number of issues
+        closed per week during the last `weeks` weeks before `now`.'''
+        numpy = _import_numpy()
+        (codes, keys, rows) = self._group(by)
+        (codes, seconds) = self._closings(codes, rows)
+        now = _epoch_seconds(numpy, now)
+        recent = (seconds > now - weeks * WEEK_SECONDS) & (seconds <= now)
+        counts = numpy.bincount(codes[recent], minlength=len(keys))
+        return dict(zip(keys, (counts / float(weeks)).tolist()))
+
+    def projected_completion(self, by='milestone', weeks=4, now=None):
+        '''Projects when the open issues of each group will be closed if
+        they keep being closed at the velocity of the last `weeks` weeks.
+
+        :return: A dict mapping each group to a datetime. Completed groups
+                 map to the date of their last closing, and groups with
+                 open issues but no recent closing map to None.
+        '''
+        numpy = _import_numpy()
+        (codes, keys, rows) = self._group(by)
+        (codes, seconds) = self._closings(codes, rows)
+        now = _epoch_seconds(numpy, now)
+        rollups = self.rollup(by)
+        velocities = self.velocity(by, weeks, now)
+
+        # Last closing of each group: sort the closings by group, then by
+        # date, and take the last one of each group.
+        order = numpy.lexsort((seconds, codes))
+        (codes, seconds) = (codes[order], seconds[order])
+        last = numpy.append(numpy.flatnonzero(numpy.diff(codes)),
+                len(codes) - 1) if len(codes) else numpy.arange(0)
+        last_closings = dict(zip(codes[last].tolist(),
+            seconds[last].tolist()))
+
+        projections = {}
+        for (code, key) in enumerate(keys):
+            rollup = rollups[key]
+            if rollup.opened == 0:
+                projected = last_closings.get(code)
+            elif velocities[key] > 0:
+                projected = now + rollup.opened / velocities[key] * \
+                        WEEK_SECONDS
+            else:
+                projected = None
+            if projected is not None:
+                projected = datetime.datetime.utcfromtimestamp(projected)
+            projections[key] = projected
+        return projections
+
+    def _closings(self, codes, rows):
+        '''Returns the group codes and the closing dates (in seconds since
+        the epoch) of the closed issues with a known closing date.'''
+        numpy = _import_numpy()
+        closed_at = self.closed_at[rows]
+        known = ~numpy.isnat(closed_at) & ~self.opened[rows]
+        return (codes[rows][known], closed_at[known].astype('int64'))
+
+def _datetime_column(numpy, dates):
+    # About five times faster than letting NumPy convert the datetimes.
+    epoch = EPOCH_ORDINAL
+    return numpy.array([(date.toordinal() - epoch) * 86400 +
+        date.hour * 3600 + date.minute * 60 + date.second
+        if date is not None else NAT for date in dates],
+        dtype='int64').view('datetime64[s]')
+
+def _epoch_seconds(numpy, date):
+    if date is None:
+        date = datetime.datetime.now()
+    if isinstance(date, (int, long, float, numpy.number)):
+        return date
+    return int(numpy.datetime64(date, 's').astype('int64'))
+
+
+#### EXPORT ####
+
+EXPORT_FORMATS = ('json', 'jsonl', 'csv')
+'''Formats supported by `export_milestones` and `load_milestones`'''
+
+CSV_COLUMNS = ('milestone', 'number', 'title', 'state', 'labels',
+        'updated_at', 'created_at', 'closed_at')
+'''Columns of the CSV export: one row per issue of each milestone'''
+
+ISSUE_FIELDS = ('number', 'title', 'state', 'labels', 'updated_at',
+        'created_at', 'closed_at')
+
+def milestone_to_dict(milestone):
+    '''Returns a dict representing a milestone and its issues that can be
+    serialized to JSON. Dates are ISO 8601 strings.'''
+    return {'title': milestone.title, 'total': milestone.total,
+            'opened': milestone.opened, 'closed': milestone.closed,
+            'progress': milestone.progress,
+            'synced_at': _format_date(milestone.synced_at),
+            'issues': [{'number': issue.number, 'title': issue.title,
+                'state': issue.state, 'labels': list(issue.labels or ()),
+                'updated_at': _format_date(getattr(issue, 'updated_at', None)),
+                'created_at': _format_date(getattr(issue, 'created_at', None)),
+                'closed_at': _format_date(getattr(issue, 'closed_at', None))}
+                for issue in milestone.issues]}
+
+def milestone_from_dict(record):
+    '''Builds a milestone from a dict returned by `milestone_to_dict`. The
+    counts and the progress are computed from the issues.'''
+    return Milestone(record['title'], [IssueRecord(issue['number'],
+        issue['title'], issue['state'], issue.get('labels') or (),
+        _parse_date(issue.get('updated_at')),
+        _parse_date(issue.get('created_at')),
+        _parse_date(issue.get('closed_at')))
+        for issue in record.get('issues', ())])
+
+def export_milestones(milestones, output, format='json'):
+    '''Writes milestones, one record per milestone, as they are produced by
+    `milestones`.
+
+    * json: an array of objects (see `milestone_to_dict`).
+    * jsonl: one object per line.
+    * csv: one row per issue (see `CSV_COLUMNS`) and one row without an
+      issue number for each milestone without issues. Labels are encoded as
+      a JSON array.
+
+    :param milestones: a list (or iterator) of milestones.
+    :param output: a path or a file-like object. A path is written
+           atomically.
+    :param format: one of `EXPORT_FORMATS`. (optional)
+    '''
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Unknown format {0!r}: use one of {1}'.format(format,
+            ', '.join(EXPORT_FORMATS)))
+    chunks = _EXPORTERS[format](milestones)
+    if isinstance(output, basestring):
+        write_chunks_atomically(output, chunks, 'wb')
+    else:
+        for chunk in chunks:
+            output.write(chunk)
+
+def load_milestones(source, format=None):
+    '''Loads milestones written by `export_milestones` without making any
+    request.
+
+    :param source: a path or a file-like object.
+    :param format: one of `EXPORT_FORMATS`. Guessed from the extension of
+           the path if None. (optional)
+    :return: A list of milestones.
+    '''
+    if format is None:
+        if not isinstance(source, basestring):
+            raise ValueError('The format of a file object must be provided')
+        format = os.path.splitext(source)[1][1:].lower()
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Unknown format {0!r}: use one of {1}'.format(format,
+            ', '.join(EXPORT_FORMATS)))
+    if isinstance(source, basestring):
+        with open(source, 'rb') as source_file:
+            return list(_LOADERS[format](source_file))
+    return list(_LOADERS[format](source))
+
+def _iter_json(milestones):
+    import json
+    separator = '[\n'
+    for milestone in milestones:
+        yield separator + json.dumps(milestone_to_dict(milestone))
+        separator = ',\n'
+    yield '[]\n' if separator == '[\n' else '\n]\n'
+
+def _iter_jsonl(milestones):
+    import json
+    for milestone in milestones:
+        yield json.dumps(milestone_to_dict(milestone)) + '\n'
+
+def _iter_csv(milestones):
+    import csv
+    import json
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    for milestone in milestones:
+        title = _utf8(milestone.title)
+        rows = [[title, issue.number, _utf8(issue.title), issue.state,
+            json.dumps(list(issue.labels or ())),
+            _format_date(getattr(issue, 'updated_at', None)) or '',
+            _format_date(getattr(issue, 'created_at', None)) or '',
+            _format_date(getattr(issue, 'closed_at', None)) or '']
+            for issue in milestone.issues]
+        if not rows:
+            rows = [[title] + [''] * (len(CSV_COLUMNS) - 1)]
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def _load_json(source):
+    import json
+    return (milestone_from_dict(record) for record in json.load(source))
+
+def _load_jsonl(source):
+    import json
+    for line in source:
+        if line.strip():
+            yield milestone_from_dict(json.loads(line))
+
+def _load_csv(source):
+    import csv
+    import json
+    from itertools import groupby
+    reader = csv.reader(source)
+    next(reader, None)
+    # The rows of a milestone are consecutive.
+    for (title, rows) in groupby(reader, lambda row: row[0]):
+        issues = [{'number': int(row[1]), 'title': row[2].decode('utf-8'),
+            'state': row[3], 'labels': json.loads(row[4]),
+            'updated_at': row[5] or None, 'created_at': row[6] or None,
+            'closed_at': row[7] or None} for row in rows if row[1]]
+        yield milestone_from_dict({'title': title.decode('utf-8'),
+            'issues': issues})
+
+_EXPORTERS = {'json': _iter_json, 'jsonl': _iter_jsonl, 'csv': _iter_csv}
+
+_LOADERS = {'json': _load_json, 'jsonl': _load_jsonl, 'csv': _load_csv}
+
+def _format_date(date):
+    if date is None or isinstance(date, basestring):
+        return date
+    return date.strftime('%Y-%m-%dT%H:%M:%S')
+
+def _parse_date(text):
+    if not text:
+        return None
+    # Faster than strptime, which matters when loading many issues.
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+            int(text[11:13]), int(text[14:16]), int(text[17:19]))
+
 
 #### HTML GENERATION ####
 
-def write_simple_html_milestones(milestones, output):
+class RoadmapTemplates(object):
+    '''Templates used to render a roadmap page.
+
+    Each template is a `str.format` string. The header receives the project
+    name and the footer the generation date as their first positional
+    field. The milestone template receives the `title`, `anchor`,
+    `progress`, `percent`, `closed`, `opened`, `total`, `project`,
+    `issues` (the rendered issues) and `stale` (`STALE_MARKER` if the
+    milestone is stale, an empty string otherwise) fields. The issue template receives the
+    `project`, `number`, `title` and `state` fields. Titles are HTML-escaped.
+
+    The templates are checked once when the object is created so that an
+    unknown field is reported before any milestone is fetched.
+    '''
+
+    milestone_fields = frozenset(('title', 'anchor', 'progress', 'percent',
+        'closed', 'opened', 'total', 'project', 'issues', 'stale'))
+
+    issue_fields = frozenset(('project', 'number', 'title', 'state'))
+
+    def __init__(self, header, footer, milestone, issue):
+        # Pages are rendered as unicode and only encoded when written.
+        (header, footer, milestone, issue) = (_text(header), _text(footer),
+                _text(milestone), _text(issue))
+        self.header = header
+        self.footer = footer
+        self.milestone = milestone
+        self.issue = issue
+        _check_template(milestone, self.milestone_fields)
+        _check_template(issue, self.issue_fields)
+        self._format_milestone = milestone.format
+        self._format_issue = issue.format
+
+    def render_header(self, project_name):
+        return self.header.format(project_name)
+
+    def render_footer(self):
+        return self.footer.format(str(datetime.datetime.now()))
+
+    def render_milestone(self, milestone, project=None):
+        format_issue = self._format_issue
+        issues = ''.join([format_issue(project=project, number=issue.number,
+            title=_escape(issue.title), state=issue.state)
+            for issue in milestone.issues])
+        title = _escape(milestone.title, True)
+        return self._format_milestone(title=title,
+                anchor=title.replace('.', '--'),
+                progress=milestone.progress,
+                percent=int(milestone.progress), closed=milestone.closed,
+                opened=milestone.opened, total=milestone.total,
+                project=project, issues=issues,
+                stale=STALE_MARKER if getattr(milestone, 'stale', False)
+                else '')
+
+def _escape(text, quote=False):
+    # Same as cgi.escape, which is slow to import.
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if quote:
+        text = text.replace('"', '&quot;')
+    return text
+
+def _check_template(template, fields):
+    for (_, field_name, _, _) in Formatter().parse(template):
+        if field_name is None:
+            continue
+        name = field_name.split('.')[0].split('[')[0]
+        if name not in fields:
+            raise ValueError('Unknown field {0!r} in template'.format(name))
+
+SIMPLE_TEMPLATES = RoadmapTemplates(SIMPLE_HTML_HEADER, SIMPLE_HTML_FOOTER,
+        SIMPLE_MILESTONE_TEMPLATE, SIMPLE_ISSUE_TEMPLATE)
+'''Templates of the simple roadmap page'''
+
+FANCY_TEMPLATES = RoadmapTemplates(FANCY_HTML_HEADER, FANCY_HTML_FOOTER,
+        FANCY_MILESTONE_TEMPLATE, FANCY_ISSUE_TEMPLATE)
+'''Templates of the fancy roadmap page'''
+
+def write_simple_html_milestones(milestones, output,
+        templates=SIMPLE_TEMPLATES):
     for milestone in milestones:
-        output.write('<h2>Milestone: {0}</h2>\n'.format(milestone.title))
-        output.write('<p><strong>Progress: {0}%</strong></p>'
-                .format(milestone.progress))
-        output.write('<p><em>Number of tickets: ')
-        output.write('closed: {0} active: {1} total: {2}</em></p>\n'
-                .format(milestone.closed, milestone.opened, milestone.total))
-        output.write('<p>Issues:</p>\n<ul>\n')
-        for issue in milestone.issues:
-            output.write('<li> #{0} {1} <em>{2}</em></li>\n'
-                    .format(issue.number, issue.title, issue.state))
-        output.write('</ul>\n')
+        output.write(_utf8(templates.render_milestone(milestone)))
+
+def iter_simple_html_page(milestones, project_name = 'GitHub Project',
+        header=None, footer=None, templates=SIMPLE_TEMPLATES, metrics=None):
+    '''Generates the chunks of a simple HTML page similar to a Trac roadmap.
+    Each milestone is rendered as soon as it is produced by `milestones` so
+    the generator, once encoded, can be used as the body of a WSGI response.
+
+    :param milestones: a list (or iterator) of milestones.
+    :param project_name: a human-readable project name. (optional)
+    :param header: the HTML header used to generate the HTML page. Defaults
+           to the header of the templates. (optional)
+    :param footer: the HTML footer used to generate the HTML page. Defaults
+           to the footer of the templates. (optional)
+    :param templates: the `RoadmapTemplates` used to render the page.
+           (optional)
+    :param metrics: a `Metrics` recording the rendering time of the
+           milestones as the `render` phase. (optional)
+    :return: A generator of unicode strings.
+    '''
+    templates = _override_templates(templates, header, footer)
+
+    yield templates.render_header(project_name)
+
+    for milestone in milestones:
+        # Only the rendering is timed: fetching the milestones is recorded by
+        # the client.
+        with _Phase(metrics, 'render'):
+            chunk = templates.render_milestone(milestone)
+        yield chunk
+
+    yield templates.render_footer()
 
 def get_simple_html_page(milestones, project_name = 'GitHub Project', 
-        save_path=None, header=SIMPLE_HTML_HEADER, footer=SIMPLE_HTML_FOOTER):
+        save_path=None, header=None, footer=None, output=None, atomic=False,
+        templates=SIMPLE_TEMPLATES, metrics=None):
     '''Generates a simple HTML page similar to a Trac roadmap.
 
     :param milestones: a list (or iterator) of milestones.
     :param project_name: a human-readable project name. (optional)
     :param save_path: the output path used to save the HTML page. If None, a
            string containing the HTML page will be returned instead.
-    :param header: the HTML header used to generate the HTML page. (optional)
-    :param footer: the HTML footer used to generate the HTML page. (optional)
-    :return: None if a save_path is provided, an HTML string otherwise.
+    :param header: the HTML header used to generate the HTML page. Defaults
+           to the header of the templates. (optional)
+    :param footer: the HTML footer used to generate the HTML page. Defaults
+           to the footer of the templates. (optional)
+    :param output: a file-like object to which the HTML page is written
+           and flushed milestone by milestone. Takes precedence over
+           save_path. (optional)
+    :param atomic: if True, the page is written to a temporary file that
+           is renamed to save_path once complete. (optional)
+    :param templates: the `RoadmapTemplates` used to render the page.
+           (optional)
+    :param metrics: a `Metrics` recording the rendering time of the
+           milestones as the `render` phase. (optional)
+    :return: None if a save_path or an output is provided, an HTML unicode
+           string otherwise.
     '''
 
-    return_value = None
-
-    if save_path is None:
-        output = StringIO.StringIO()
+    chunks = iter_simple_html_page(milestones, project_name, header, footer,
+            templates, metrics)
+
+    return write_html_page(chunks, save_path, output, atomic)
+
+def _override_templates(templates, header, footer):
+    if header is None and footer is None:
+        return templates
+    return RoadmapTemplates(header or templates.header,
+            footer or templates.footer, templates.milestone, templates.issue)
+
+def write_html_page(chunks, save_path=None, output=None, atomic=False):
+    '''Writes the chunks of an HTML page to a file-like object or to a
+    file.
+
+    :param chunks: an iterable of unicode strings. They are encoded in UTF-8
+           when they are written.
+    :param save_path: the output path used to save the HTML page. If None and
+           no output is provided, a string containing the HTML page will be
+           returned instead.
+    :param output: a file-like object. It is flushed after each chunk.
+    :param atomic: if True, the page is written to a temporary file that is
+           renamed to save_path once complete.
+    :return: None if a save_path or an output is provided, an HTML unicode
+           string otherwise.
+    '''
+    if output is not None:
+        for chunk in chunks:
+            output.write(_utf8(chunk))
+            if hasattr(output, 'flush'):
+                output.flush()
+    elif save_path is None:
+        return u''.join(chunks)
+    elif atomic:
+        write_chunks_atomically(save_path, (_utf8(chunk) for chunk in chunks),
+                'wb')
     else:
-        output = open(save_path, 'w')
+        with open(save_path, 'wb') as page_file:
+            for chunk in chunks:
+                page_file.write(_utf8(chunk))
 
-    output.write(header.format(project_name))
+    return None
 
-    write_simple_html_milestones(milestones, output)
 
-    output.write(footer.format(str(datetime.datetime.now())))
+def write_fancy_html_milestones(milestones, project, output,
+        templates=FANCY_TEMPLATES):
+    for milestone in milestones:
+        output.write(_utf8(templates.render_milestone(milestone, project)))
 
-    if save_path is None:
-        return_value = output.getvalue()
+def iter_fancy_html_page(milestones, project, project_name = None,
+        header=None, footer=None, templates=FANCY_TEMPLATES, metrics=None):
+    '''Generates the chunks of a fancy HTML page similar to a Trac roadmap.
+    Each milestone is rendered as soon as it is produced by `milestones` so
+    the generator, once encoded, can be used as the body of a WSGI response.
 
-    output.close()
+    :param milestones: a list (or iterator) of milestones.
+    :param project: a string of the form `user/project`
+    :param project_name: a human-readable project name. (optional)
+    :param header: the HTML header used to generate the HTML page. Defaults
+           to the header of the templates. (optional)
+    :param footer: the HTML footer used to generate the HTML page. Defaults
+           to the footer of the templates. (optional)
+    :param templates: the `RoadmapTemplates` used to render the page.
+           (optional)
+    :param metrics: a `Metrics` recording the rendering time of the
+           milestones as the `render` phase. (optional)
+    :return: A generator of unicode strings.
+    '''
+    if project_name is None:
+        project_name = project.split('/')[1]
 
-    return return_value
+    templates = _override_templates(templates, header, footer)
 
+    yield templates.render_header(project_name)
 
-def write_fancy_html_milestones(milestones, project, output):
     for milestone in milestones:
-        new_title = milestone.title.replace('.','--')
-        progress = int(milestone.progress)
+        with _Phase(metrics, 'render'):
+            chunk = templates.render_milestone(milestone, project)
+        yield chunk
 
-        output.write('<a name="{0}"></a>'.format(milestone.title))
-        output.write('<h2>Milestone: {0}</h2>\n'.format(milestone.title))
-        output.write('''
-        <script type="text/javascript">
-        $(function() {{
-          $("#progressbar{0}").progressbar({{value: {1} }});
-          }});
-        </script>
-        '''.format(new_title,progress))
-        output.write('''
-        <div class="pb">
-        <div id="progressbar{0}"></div>
-        <div class="pb_label">{1}%</div>
-        </div>
-        '''.format(new_title, progress))
-        output.write('''
-        <dl class="tickets">
-          <dt>Number of tickets:</dt><dd></dd>
-          <dt>closed:</dt>
-          <dd>{0}</dd>
-          <dt>active:</dt>
-          <dd>{1}</dd>
-          <dt>total:</dt>
-          <dd>{2}</dd>
-        </dl>
-        '''.format(milestone.closed, milestone.opened, milestone.total))
-        output.write('<p><a href="#{0}" class="details">'
-                .format(milestone.title))
-        output.write('List of Issues:</a></p>\n')
-        output.write('<ul class="issues_list">\n')
-        for issue in milestone.issues:
-            output.write(
-                    '<li><a href="https://github.com/{0}/issues/{1}">#{1}</a>'
-                    .format(project, issue.number))
-            output.write(' {0}'.format(issue.title))
-            output.write(' <strong>- {0}</strong></li>\n'.format(issue.state))
-        output.write('</ul>\n')
+    yield templates.render_footer()
 
 def get_fancy_html_page(milestones, project, project_name = None,
-        save_path=None, header=FANCY_HTML_HEADER, footer=FANCY_HTML_FOOTER):
+        save_path=None, header=None, footer=None, output=None, atomic=False,
+        templates=FANCY_TEMPLATES, metrics=None):
     '''Generates a fancy HTML page similar to a Trac roadmap.
 
     :param milestones: a list (or iterator) of milestones.
@@ -494,32 +2635,691 @@ def get_fancy_html_page(milestones, project, project_name = None,
     :param project_name: a human-readable project name. (optional)
     :param save_path: the output path used to save the HTML page. If None, a
            string containing the HTML page will be returned instead.
-    :param header: the HTML header used to generate the HTML page. (optional)
-    :param footer: the HTML footer used to generate the HTML page. (optional)
-    :return: None if a save_path is provided, an HTML string otherwise.
+    :param header: the HTML header used to generate the HTML page. Defaults
+           to the header of the templates. (optional)
+    :param footer: the HTML footer used to generate the HTML page. Defaults
+           to the footer of the templates. (optional)
+    :param output: a file-like object to which the HTML page is written
+           and flushed milestone by milestone. Takes precedence over
+           save_path. (optional)
+    :param atomic: if True, the page is written to a temporary file that
+           is renamed to save_path once complete. (optional)
+    :param templates: the `RoadmapTemplates` used to render the page.
+           (optional)
+    :param metrics: a `Metrics` recording the rendering time of the
+           milestones as the `render` phase. (optional)
+    :return: None if a save_path or an output is provided, an HTML unicode
+           string otherwise.
     '''
 
-    return_value = None
+    chunks = iter_fancy_html_page(milestones, project, project_name, header,
+            footer, templates, metrics)
+
+    return write_html_page(chunks, save_path, output, atomic)
+
+
+#### SITE GENERATION ####
 
+SITE_MANIFEST = '.ghmiles-manifest.json'
+'''Name of the file recording the content hash of each page of a site'''
+
+def build_roadmap_site(milestones, project, output_dir, project_name=None,
+        templates=FANCY_TEMPLATES, gzip=False):
+    '''Writes a roadmap as a static site: an index page summarizing the
+    milestones and linking to one page per milestone. Readers only download
+    the issues of the milestone they look at.
+
+    The content hash of each page is recorded in a manifest so that only
+    the pages whose milestone changed are rendered again, and the pages of
+    milestones that disappeared are removed.
+
+    :param milestones: a list (or iterator) of milestones.
+    :param project: a string of the form `user/project`
+    :param output_dir: the directory of the site. It is created if needed.
+    :param project_name: a human-readable project name. (optional)
+    :param templates: the `RoadmapTemplates` used to render the milestone
+           pages. The index uses their header and footer. (optional)
+    :param gzip: if True, a precompressed `.gz` sibling is written with each
+           page. (optional)
+    :return: The list of the pages that were written.
+    '''
+    import json
+    milestones = list(milestones)
     if project_name is None:
         project_name = project.split('/')[1]
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    manifest_path = os.path.join(output_dir, SITE_MANIFEST)
+    try:
+        with open(manifest_path) as manifest_file:
+            old_manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        old_manifest = {}
+    version = _templates_hash(templates, project_name, gzip)
+    if old_manifest.get('version') != version:
+        old_pages = {}
+    else:
+        old_pages = old_manifest.get('pages', {})
+
+    pages = {}
+    written = []
+    page_names = _milestone_pages(milestones)
+    content_hashes = [milestone.content_hash() for milestone in milestones]
+    for (milestone, page, content_hash) in zip(milestones, page_names,
+            content_hashes):
+        pages[page] = content_hash
+        if old_pages.get(page) != content_hash or \
+                not os.path.exists(os.path.join(output_dir, page)):
+            chunks = iter_milestone_html_page(milestone, project,
+                    project_name, templates)
+            _write_site_page(os.path.join(output_dir, page), chunks, gzip)
+            written.append(page)
+
+    index_hash = _combine_hashes(content_hashes)
+    pages['index.html'] = index_hash
+    if old_pages.get('index.html') != index_hash or \
+            not os.path.exists(os.path.join(output_dir, 'index.html')):
+        chunks = iter_site_index_html_page(milestones, page_names,
+                project_name, templates)
+        _write_site_page(os.path.join(output_dir, 'index.html'), chunks, gzip)
+        written.append('index.html')
+
+    for page in set(old_manifest.get('pages', ())) - set(pages):
+        _safe_remove(os.path.join(output_dir, page))
+        _safe_remove(os.path.join(output_dir, page + '.gz'))
+
+    write_file_atomically(manifest_path, json.dumps({'version': version,
+        'pages': pages}, indent=1, sort_keys=True))
+
+    return written
+
+def iter_milestone_html_page(milestone, project, project_name=None,
+        templates=FANCY_TEMPLATES):
+    '''Generates the chunks of the page of a single milestone.'''
+    if project_name is None:
+        project_name = project.split('/')[1]
+    yield templates.render_header(u'{0} {1}'.format(project_name,
+        milestone.title))
+    yield templates.render_milestone(milestone, project)
+    yield templates.render_footer()
+
+def iter_site_index_html_page(milestones, pages, project_name,
+        templates=FANCY_TEMPLATES):
+    '''Generates the chunks of the index of a site: the progress of each
+    milestone and a link to its page.'''
+    yield templates.render_header(project_name)
+    for (milestone, page) in zip(milestones, pages):
+        yield SITE_MILESTONE_TEMPLATE.format(page=_escape(page, True),
+                title=_escape(milestone.title), percent=int(milestone.progress),
+                closed=milestone.closed, opened=milestone.opened,
+                total=milestone.total, stale=STALE_MARKER if getattr(
+                    milestone, 'stale', False) else '')
+    yield templates.render_footer()
+
+def _milestone_pages(milestones):
+    import hashlib
+    pages = []
+    for milestone in milestones:
+        slug = re.sub(r'[^A-Za-z0-9._-]', '_', milestone.title)
+        if slug != milestone.title:
+            # Keeps lossy slugs (e.g., 'v 1' and 'v_1') apart.
+            slug = '{0}-{1}'.format(slug, hashlib.sha1(
+                _utf8(milestone.title)).hexdigest()[:8])
+        pages.append('milestone-{0}.html'.format(slug))
+    return pages
+
+def _templates_hash(templates, *options):
+    import hashlib
+    digest = hashlib.sha1()
+    for text in (templates.header, templates.footer, templates.milestone,
+            templates.issue, SITE_MILESTONE_TEMPLATE) + options:
+        digest.update(_utf8(u'{0}\0'.format(text)))
+    return digest.hexdigest()
+
+def _write_site_page(path, chunks, gzip):
+    content = _utf8(u''.join(chunks))
+    write_file_atomically(path, content, 'wb')
+    if gzip:
+        import gzip as gzip_module
+        buf = StringIO.StringIO()
+        # mtime=0 makes the compressed file only depend on the page.
+        with gzip_module.GzipFile(filename='', mode='wb', fileobj=buf,
+                mtime=0) as gzip_file:
+            gzip_file.write(content)
+        write_file_atomically(path + '.gz', buf.getvalue(), 'wb')
+    else:
+        # A sibling left by an earlier gzip build would be served stale.
+        _safe_remove(path + '.gz')
+
+
+#### BATCH GENERATION ####
+
+class Roadmap(object):
+    '''Result of the generation of a project roadmap by `build_roadmaps`.
+    If the generation failed, `error` contains the exception and
+    `milestones` is empty. `changed` is False if the page was not rewritten
+    because its milestones did not change.'''
+
+    __slots__ = ('project', 'milestones', 'page', 'error', 'changed')
+
+    def __init__(self, project, milestones=(), page=None, error=None,
+            changed=True):
+        self.project = project
+        self.milestones = list(milestones)
+        self.page = page
+        self.error = error
+        self.changed = changed
+
+    def __repr__(self):
+        return '<Roadmap: {0}, {1} milestones>'.format(self.project,
+                len(self.milestones))
+
+def build_roadmaps(projects, output_dir, github=None, workers=4,
+        milestone_regex=None, fancy=True, index_name='index.html',
+        fingerprints=None, site=False, gzip=False):
+    '''Generates the roadmaps of several github projects and an index page
+    linking to them. All projects share the same client (and rate limit);
+    up to `workers` projects are fetched concurrently, each with one request
+    for its labels and two for its issues.
+
+    :param projects: a list of strings of the form `user/project`
+    :param output_dir: the directory where the pages are written. The page
+           of `user/project` is `user_project.html`.
+    :param github: a Github client (optional).
+    :param workers: the maximum number of projects fetched at the same
+           time. (optional)
+    :param milestone_regex: a regular expression used to identify the labels
+           representing milestones. If None, the labels are identified with
+           `get_intel_milestone_labels`. (optional)
+    :param fancy: If True (default), fancy pages are generated. Simple pages
+           otherwise.
+    :param index_name: the file name of the index page, or None to skip
+           it. (optional)
+    :param fingerprints: a dict mapping projects to the hash of their
+           milestones, updated by the call. Pages of projects whose
+           milestones did not change are not rewritten, and the index page
+           is only rewritten if a project changed. (optional)
+    :param site: if True, each project is written as a site with one page
+           per milestone in the `user_project` directory. See
+           `build_roadmap_site`. (optional)
+    :param gzip: if True, precompressed `.gz` siblings of the pages of the
+           sites are written. (optional)
+    :return: A list of `Roadmap`, in the order of the projects.
+    '''
+    github = _client(github)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
 
-    if save_path is None:
-        output = StringIO.StringIO()
+    def build(project):
+        return build_roadmap(project, output_dir, github, milestone_regex,
+                fancy, fingerprints, site, gzip)
+
+    projects = list(projects)
+    if workers is None or workers < 2 or len(projects) < 2:
+        roadmaps = [build(project) for project in projects]
     else:
-        output = open(save_path, 'w')
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(projects)))
+        try:
+            roadmaps = pool.map(build, projects)
+        finally:
+            pool.terminate()
+
+    index_path = None
+    if index_name is not None:
+        index_path = os.path.join(output_dir, index_name)
+    if index_path is not None and (fingerprints is None or
+            not os.path.exists(index_path) or
+            any(roadmap.changed for roadmap in roadmaps)):
+        write_chunks_atomically(index_path, (_utf8(chunk) for chunk in
+            iter_index_html_page(roadmaps)), 'wb')
+
+    return roadmaps
+
+def build_roadmap(project, output_dir, github=None, milestone_regex=None,
+        fancy=True, fingerprints=None, site=False, gzip=False):
+    '''Generates the roadmap of a github project in a directory. Errors
+    are reported in the returned `Roadmap` instead of being raised.
 
-    output.write(header.format(project_name))
+    :param project: a string of the form `user/project`
+    :param output_dir: the directory where the page is written.
+    :param github: a Github client (optional).
+    :param milestone_regex: a regular expression used to identify the labels
+           representing milestones. If None, the labels are identified with
+           `get_intel_milestone_labels`. (optional)
+    :param fancy: If True (default), a fancy page is generated. A simple
+           page otherwise.
+    :param fingerprints: a dict mapping projects to the hash of their
+           milestones. If the hash did not change, the page is not
+           rewritten. The dict is updated. (optional)
+    :param site: if True, the roadmap is written as a site with one page per
+           milestone in the `user_project` directory. (optional)
+    :param gzip: if True, precompressed `.gz` siblings of the pages of the
+           site are written. (optional)
+    :return: A `Roadmap`.
+    '''
+    github = _client(github)
+    page = project.replace('/', '_') + '.html'
+    if site:
+        page = project.replace('/', '_') + '/index.html'
+    try:
+        if milestone_regex is None:
+            (labels, _) = get_intel_milestone_labels(project, github=github)
+        else:
+            labels = list(get_milestone_labels(project, milestone_regex,
+                github=github))
+        milestones = list(get_milestones_from_labels(project, labels,
+            github, bulk=True))
+        save_path = os.path.join(output_dir, page)
+        if fingerprints is not None:
+            fingerprint = milestones_hash(milestones)
+            if fingerprints.get(project) == fingerprint and \
+                    os.path.exists(save_path):
+                return Roadmap(project, milestones, page, changed=False)
+        metrics = _client_metrics(github)
+        if site:
+            build_roadmap_site(milestones, project, os.path.dirname(save_path),
+                    templates=FANCY_TEMPLATES if fancy else SIMPLE_TEMPLATES,
+                    gzip=gzip)
+        elif fancy:
+            get_fancy_html_page(milestones, project, save_path=save_path,
+                    atomic=True, metrics=metrics)
+        else:
+            get_simple_html_page(milestones, project.split('/')[1],
+                    save_path=save_path, atomic=True, metrics=metrics)
+    except Exception as error:
+        return Roadmap(project, error=error)
 
-    write_fancy_html_milestones(milestones, project, output)
+    if fingerprints is not None:
+        fingerprints[project] = fingerprint
 
-    output.write(footer.format(str(datetime.datetime.now())))
+    return Roadmap(project, milestones, page)
 
-    if save_path is None:
-        return_value = output.getvalue()
+def iter_index_html_page(roadmaps, title='Projects',
+        templates=SIMPLE_TEMPLATES):
+    '''Generates the chunks of an HTML page summarizing several roadmaps.
 
-    output.close()
+    :param roadmaps: a list (or iterator) of `Roadmap`.
+    :param title: the title of the page. (optional)
+    :param templates: the `RoadmapTemplates` providing the header and the
+           footer of the page. (optional)
+    :return: A generator of unicode strings.
+    '''
+    yield templates.render_header(title)
+    yield u'<ul>\n'
+    for roadmap in roadmaps:
+        if roadmap.error is not None:
+            yield INDEX_ERROR_TEMPLATE.format(project=_escape(roadmap.project),
+                    error=_escape(str(roadmap.error)))
+            continue
+        total = sum(milestone.total for milestone in roadmap.milestones)
+        closed = sum(milestone.closed for milestone in roadmap.milestones)
+        if total:
+            percent = closed * 100 // total
+        else:
+            percent = 0
+        yield INDEX_PROJECT_TEMPLATE.format(page=_escape(roadmap.page, True),
+                project=_escape(roadmap.project),
+                milestones=len(roadmap.milestones), closed=closed,
+                total=total, percent=percent)
+    yield u'</ul>\n'
+    yield templates.render_footer()
+
+
+#### ASYNCHRONOUS API ####
+
+class PendingResult(object):
+    '''Result of a call made through an `AsyncClient`. The callback (or the
+    errback if the call failed) is called from a worker thread when the
+    result is available. The result can also be waited for.'''
+
+    def __init__(self, callback=None, errback=None):
+        self.callback = callback
+        self.errback = errback
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+        if self.callback is not None:
+            self.callback(value)
+
+    def set_error(self, error):
+        self.error = error
+        self.event.set()
+        if self.errback is not None:
+            self.errback(error)
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        '''Waits for the result and returns it, or raises the error of the
+        call. Raises RuntimeError if the timeout expires.'''
+        if not self.event.wait(timeout):
+            raise RuntimeError('The call did not complete in time')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class AsyncClient(object):
+    '''Non-blocking counterpart of the milestone functions and of the HTML
+    writers. Calls return a `PendingResult` at once and the work is done by
+    a pool of `workers` threads shared by all the calls, so many roadmaps
+    can be served concurrently without a thread per request. The milestones
+    are the same model objects and all the calls share the client (and its
+    rate limiter).
+
+    Results are delivered to callbacks called from the worker threads. An
+    event loop bridges them with its thread-safe scheduling function, e.g.,
+    `loop.call_soon_threadsafe` with asyncio.
 
-    return return_value
+    :param github: a Github client (optional).
+    :param workers: the number of worker threads. (optional)
+    '''
+
+    def __init__(self, github=None, workers=4):
+        github = _client(github)
+        self.github = github
+        self.workers = workers
+        self.lock = threading.Lock()
+        self._pool = None
+
+    def _submit(self, function, args, result):
+        def run():
+            try:
+                value = function(*args)
+            except Exception as error:
+                result.set_error(error)
+                return
+            try:
+                result.set_result(value)
+            except Exception as error:
+                # The pool swallows exceptions: a failing callback must
+                # complete the result (and the calls waiting for it).
+                result.set_error(error)
+        with self.lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.workers)
+            pool = self._pool
+        pool.apply_async(run)
+        return result
+
+    def get_milestone_labels(self, project, callback=None, errback=None,
+            milestone_regex=None, reverse=True):
+        '''Lists the milestone labels of a project, sorted. If
+        milestone_regex is None, the labels are identified with
+        `get_intel_milestone_labels`.'''
+        return self._submit(_sorted_milestone_labels, (project,
+            milestone_regex, reverse, self.github),
+            PendingResult(callback, errback))
+
+    def get_milestone(self, project, milestone_label, callback=None,
+            errback=None):
+        return self._submit(get_milestone, (project, milestone_label,
+            self.github), PendingResult(callback, errback))
+
+    def get_milestones(self, project, on_milestone=None, callback=None,
+            errback=None, milestone_regex=None, reverse=True, labels=None):
+        '''Fetches the milestones of a project concurrently.
+
+        :param on_milestone: called with each milestone, in the order of the
+               labels, as soon as it and the previous ones are fetched.
+               (optional)
+        :param callback: called with the list of milestones. (optional)
+        :param errback: called with the first error. (optional)
+        :param labels: the labels of the milestones. If None, they are
+               listed with `get_milestone_labels`. (optional)
+        :return: A `PendingResult` of the list of milestones.
+        '''
+        result = PendingResult(callback, errback)
+
+        def fetch(labels):
+            delivery = _OrderedDelivery(len(labels), on_milestone, result)
+            for (index, label) in enumerate(labels):
+                self._submit(get_milestone, (project, label, self.github),
+                        PendingResult(delivery.callback(index),
+                            delivery.fail))
+
+        if labels is None:
+            self.get_milestone_labels(project, fetch, result.set_error,
+                    milestone_regex, reverse)
+        else:
+            fetch(list(labels))
+        return result
+
+    def stream_page(self, project, on_chunk, callback=None, errback=None,
+            milestone_regex=None, fancy=True, project_name=None,
+            templates=None):
+        '''Renders the roadmap page of a project while its milestones are
+        fetched: the header is delivered at once, then each milestone as
+        soon as it is rendered, then the footer.
+
+        :param on_chunk: called with each chunk of the page, a unicode
+               string.
+        :param callback: called with the list of milestones once the footer
+               is delivered. (optional)
+        :return: A `PendingResult` of the list of milestones.
+        '''
+        if templates is None:
+            templates = FANCY_TEMPLATES if fancy else SIMPLE_TEMPLATES
+        if project_name is None:
+            project_name = project.split('/')[1]
+        result = PendingResult(callback, errback)
+
+        def finish(milestones):
+            on_chunk(templates.render_footer())
+            result.set_result(milestones)
+
+        on_chunk(templates.render_header(project_name))
+        self.get_milestones(project, lambda milestone: on_chunk(
+            templates.render_milestone(milestone, project)), finish,
+            result.set_error, milestone_regex)
+        return result
+
+    def close(self):
+        '''Stops the worker threads. Pending calls are abandoned.'''
+        with self.lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.terminate()
+
+
+class _OrderedDelivery(object):
+    '''Delivers items produced out of order in the order of their index.'''
+
+    def __init__(self, count, on_item, result):
+        self.items = [None] * count
+        self.ready = [False] * count
+        self.next = 0
+        self.on_item = on_item
+        self.result = result
+        self.failed = False
+        self.lock = threading.Lock()
+        if not count:
+            result.set_result([])
+
+    def callback(self, index):
+        return lambda item: self.add(index, item)
+
+    def add(self, index, item):
+        with self.lock:
+            if self.failed:
+                return
+            self.items[index] = item
+            self.ready[index] = True
+            error = None
+            # on_item is called with the lock held so that the items are
+            # delivered in order.
+            try:
+                while self.next < len(self.items) and self.ready[self.next]:
+                    if self.on_item is not None:
+                        self.on_item(self.items[self.next])
+                    self.next += 1
+            except Exception as exception:
+                error = exception
+                self.failed = True
+            finished = self.next == len(self.items)
+        if error is not None:
+            self.result.set_error(error)
+        elif finished:
+            self.result.set_result(self.items)
+
+    def fail(self, error):
+        with self.lock:
+            if self.failed:
+                return
+            self.failed = True
+        self.result.set_error(error)
+
+def _sorted_milestone_labels(project, milestone_regex, reverse, github):
+    if milestone_regex is None:
+        return get_intel_milestone_labels(project, reverse, github)[0]
+    return list(get_milestone_labels(project, milestone_regex, reverse,
+        github))
+
+
+#### COMMAND LINE ####
+
+USAGE = '''%prog [options] user/project [user/project ...]
+
+Generates the roadmap of github projects in a directory.'''
+
+def main(argv=None, github=None):
+    '''Entry point of the ghmiles command.
+
+    :param argv: the command line arguments, without the program name.
+           Defaults to `sys.argv[1:]`.
+    :param github: a Github client. If None, a client is created from the
+           command line options. (optional)
+    :return: the exit status.
+    '''
+    from optparse import OptionParser
+    parser = OptionParser(usage=USAGE)
+    parser.add_option('-o', '--output', default='.',
+            help='directory where the pages are written [default: %default]')
+    parser.add_option('-r', '--regex', default=None,
+            help='regular expression identifying milestone labels '
+            '[default: guessed for each project]')
+    parser.add_option('-s', '--simple', action='store_true', default=False,
+            help='generate simple pages instead of fancy pages')
+    parser.add_option('--site', action='store_true', default=False,
+            help='write each project as a site with one page per milestone')
+    parser.add_option('--gzip', action='store_true', default=False,
+            help='write precompressed .gz copies of the pages of the sites')
+    parser.add_option('-w', '--workers', type='int', default=4,
+            help='number of projects fetched concurrently [default: '
+            '%default]')
+    parser.add_option('--watch', type='float', default=None,
+            metavar='SECONDS', help='keep running and regenerate the pages '
+            'whose milestones changed every SECONDS')
+    parser.add_option('--cache-dir', default=None,
+            help='directory where the API responses are cached')
+    parser.add_option('--cache-ttl', type='float', default=60,
+            help='number of seconds during which cached responses are used '
+            'without being revalidated [default: %default]')
+    parser.add_option('--requests-per-minute', type='int', default=60,
+            help='maximum number of API requests per minute [default: '
+            '%default]')
+    parser.add_option('-u', '--username', default=None,
+            help='github username')
+    parser.add_option('-t', '--token', default=None, help='github API token')
+    parser.add_option('-d', '--debug', action='store_true', default=False,
+            help='print the API requests on stderr')
+    parser.add_option('--metrics', default=None, metavar='FILE',
+            help='write a JSON summary of the requests and of the time spent '
+            'in each phase to FILE after each build (- for stderr)')
+    parser.add_option('--export', default=None, metavar='FORMAT',
+            choices=EXPORT_FORMATS, help='also export the milestones of '
+            'each project as user_project.FORMAT (json, jsonl or csv)')
+    parser.add_option('--history', default=None, metavar='FILE',
+            help='record the progress of the milestones in the SQLite '
+            'database FILE after each build')
+
+    (options, projects) = parser.parse_args(argv)
+    if not projects:
+        parser.error('at least one project is required')
+
+    metrics = None
+    if options.metrics is not None:
+        metrics = Metrics()
 
+    if github is None:
+        if options.cache_dir is not None:
+            cache = DirectoryCache(options.cache_dir, options.cache_ttl)
+        elif options.watch:
+            cache = MemoryCache(options.cache_ttl)
+        else:
+            cache = None
+        github = Github(username=options.username, api_token=options.token,
+                debug=options.debug,
+                requests_per_minute=options.requests_per_minute, cache=cache,
+                metrics=metrics)
+    elif metrics is not None:
+        github.request.metrics = metrics
+
+    regex = None
+    if options.regex is not None:
+        regex = re.compile(options.regex)
+
+    store = None
+    if options.history is not None:
+        store = ProgressStore(options.history)
+
+    fingerprints = {}
+    previous = {}
+    while True:
+        roadmaps = build_roadmaps(projects, options.output, github,
+                options.workers, regex, not options.simple,
+                fingerprints=fingerprints, site=options.site,
+                gzip=options.gzip)
+        failed = False
+        for roadmap in roadmaps:
+            if roadmap.error is not None:
+                failed = True
+                sys.stderr.write('{0}: {1}\n'.format(roadmap.project,
+                    roadmap.error))
+                continue
+            if roadmap.changed and options.debug:
+                sys.stderr.write('{0}: {1} written\n'.format(roadmap.project,
+                    roadmap.page))
+                if roadmap.project in previous:
+                    for event in diff_milestones(previous[roadmap.project],
+                            roadmap.milestones):
+                        sys.stderr.write(_utf8(u'{0}: {1}\n'.format(
+                            roadmap.project, event.describe())))
+            previous[roadmap.project] = roadmap.milestones
+            if store is not None:
+                store.record(roadmap.project, roadmap.milestones)
+            if options.export is not None and roadmap.changed:
+                export_milestones(roadmap.milestones, os.path.join(
+                    options.output, '{0}.{1}'.format(
+                        roadmap.project.replace('/', '_'), options.export)),
+                    options.export)
+        if metrics is not None:
+            _write_metrics(metrics, options.metrics)
+            metrics.reset()
+
+        if not options.watch:
+            return 1 if failed else 0
+
+        try:
+            time.sleep(options.watch)
+        except KeyboardInterrupt:
+            return 0
+
+def _write_metrics(metrics, path):
+    summary = metrics.to_json(indent=2) + '\n'
+    if path == '-':
+        sys.stderr.write(summary)
+    else:
+        write_file_atomically(path, summary)
 
+if __name__ == '__main__':
+    sys.exit(main())
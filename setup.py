@@ -30,4 +30,8 @@ regular expression.
       url='https://github.com/bartdag/ghmiles',
       py_modules=['ghmiles'],
       install_requires=['github2>=0.2'],
+      extras_require={'stats': ['numpy']},
+      entry_points={
+          'console_scripts': ['ghmiles = ghmiles:main'],
+      },
      ) 
@@ -5,16 +5,157 @@
   :license: BSD, see LICENSE for details
 '''
 
+import datetime
+import gzip
+import os
+import pickle
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import ghmiles
+from github2.issues import Issue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def make_issue(number, state='open', labels=None, title=None,
+        updated_at='2011/02/01 10:00:00 -0800', closed_at=None):
+    if title is None:
+        title = u'Issue {0}'.format(number)
+    return Issue(number=number, state=state, title=title,
+            labels=labels or [], updated_at=updated_at, closed_at=closed_at)
+
+
+class FakeIssues(object):
+    '''Offline stand-in for the Issues command of a Github client.'''
+
+    def __init__(self, issues, delay=0):
+        self.issues = issues
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def list_labels(self, project):
+        with self.lock:
+            self.calls.append(('labels', project))
+        if project.endswith('/missing'):
+            raise RuntimeError('unexpected response from github.com 404')
+        labels = set()
+        for issue in self.issues:
+            labels.update(issue.labels)
+        return sorted(labels)
+
+    def list_by_label(self, project, label):
+        with self.lock:
+            self.calls.append(('label', label))
+        if self.delay:
+            # Later labels return first to exercise out of order fetching.
+            time.sleep(self.delay / (len(self.calls) + 1))
+        return [issue for issue in self.issues if label in issue.labels]
+
+    def list(self, project, state='open'):
+        with self.lock:
+            self.calls.append(('list', state))
+        return [issue for issue in self.issues if issue.state == state]
+
+
+class FakeGithub(object):
+
+    def __init__(self, issues, delay=0):
+        self.issues = FakeIssues(issues, delay)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status, body, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self):
+        return self.body
+
+
+class FakeConnection(object):
+    '''Replaces httplib connections: responses are popped from a list
+    shared by all connections.'''
+
+    responses = []
+    requests = []
+    connections = []
+
+    def __init__(self, hostname, *args, **kwargs):
+        self.hostname = hostname
+        FakeConnection.connections.append(self)
+
+    def request(self, method, path, body=None, headers=None):
+        FakeConnection.requests.append((method, path, headers))
+
+    def getresponse(self):
+        response = FakeConnection.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+ISSUE_JSON = ('{"number": %d, "state": "%s", "title": "Issue", '
+        '"labels": ["v0.1"], "updated_at": "2011/02/01 10:00:00 -0800"}')
+
+
+def make_offline_github(responses, **kwargs):
+    FakeConnection.responses = list(responses)
+    FakeConnection.requests = []
+    FakeConnection.connections = []
+    github = ghmiles.Github(**kwargs)
+    github.request.connector_for_scheme = {'https': FakeConnection}
+    return github
+
+
+def make_fake_github(delay=0):
+    issues = [
+        make_issue(1, 'closed', ['v0.1']),
+        make_issue(2, 'closed', ['v0.1', 'bug']),
+        make_issue(3, 'open', ['v0.2']),
+        make_issue(4, 'closed', ['v0.2']),
+        make_issue(5, 'open', ['v0.10', 'v0.2']),
+        make_issue(6, 'open', ['bug']),
+    ]
+    return FakeGithub(issues, delay)
+
 
 class TestMilestonesModel(unittest.TestCase):
 
     def test_key_label(self):
-        self.assertEqual(ghmiles.label_key('1.0'),'00001.00000')
-        self.assertEqual(ghmiles.label_key('12'),'00012')
+        self.assertEqual(ghmiles.label_key('1.0'), ('', 1, 2, '', 0, 1, ''))
         self.assertEqual(ghmiles.label_key('v3.35.67e-234b'),
-                         'v00003.00035.00067e-00234b')
+            ('v', 3, 2, '', 35, 2, '', 67, 0, 'e', 234, 0, 'b'))
+        self.assertEqual(ghmiles.label_key('bug'), ('bug',))
+        # padding is still accepted for compatibility.
+        self.assertEqual(ghmiles.label_key('1.0', padding=5),
+                ghmiles.label_key('1.0'))
+
+    def test_key_label_order(self):
+        labels = ['v1.0', 'v0.10', 'v1.0rc1', 'v0.9', 'v1.0.1', 'v1.0-beta',
+                'v0.1', 'v100000', 'v99999']
+        self.assertEqual(sorted(labels, key=ghmiles.label_key),
+                ['v0.1', 'v0.9', 'v0.10', 'v1.0-beta', 'v1.0rc1', 'v1.0',
+                 'v1.0.1', 'v99999', 'v100000'])
+        self.assertEqual(sorted(['11.0', '2.0', '2'], key=ghmiles.label_key),
+                ['2', '2.0', '11.0'])
 
     def test_get_milestone_labels(self):
         labels = list(
@@ -58,6 +199,905 @@ class TestMilestonesModel(unittest.TestCase):
         self.assertTrue(html.endswith('</html>'))
 
 
+class TestOfflineMilestones(unittest.TestCase):
+
+    def test_concurrent_milestones_keep_label_order(self):
+        github = make_fake_github(delay=0.05)
+        milestones = list(ghmiles.get_milestones('user/project',
+            ghmiles.MILESTONE_LABEL_V, False, github, workers=4))
+        self.assertEqual([m.title for m in milestones],
+                ['v0.1', 'v0.2', 'v0.10'])
+        self.assertEqual([m.total for m in milestones], [2, 3, 1])
+
+    def test_concurrent_milestones_from_labels(self):
+        github = make_fake_github()
+        milestones = list(ghmiles.get_milestones_from_labels('user/project',
+            ['v0.2', 'v0.1'], github, workers=2))
+        self.assertEqual([m.title for m in milestones], ['v0.2', 'v0.1'])
+        self.assertAlmostEqual(milestones[1].progress, 100.0)
+
+    def test_bulk_milestones(self):
+        github = make_fake_github()
+        milestones = list(ghmiles.get_milestones('user/project',
+            ghmiles.MILESTONE_LABEL_V, False, github, bulk=True))
+        self.assertEqual([m.title for m in milestones],
+                ['v0.1', 'v0.2', 'v0.10'])
+        self.assertEqual([m.total for m in milestones], [2, 3, 1])
+        self.assertEqual([m.opened for m in milestones], [0, 2, 1])
+        self.assertEqual([issue.number for issue in milestones[1].issues],
+                [3, 4, 5])
+        self.assertEqual(github.issues.calls, [('labels', 'user/project'),
+            ('list', 'open'), ('list', 'closed')])
+
+    def test_streamed_milestones(self):
+        github = make_offline_github([
+            FakeResponse(200, '{"issues": [%s, %s]}' % (
+                ISSUE_JSON % (4, 'open'), ISSUE_JSON % (2, 'closed'))),
+            FakeResponse(200, '{"issues": [%s]}' % (
+                ISSUE_JSON % (3, 'open')))])
+        milestone = ghmiles.get_milestone('user/project', 'v0.1', github,
+                page_size=2)
+        self.assertEqual([issue.number for issue in milestone.issues],
+                [2, 3, 4])
+        self.assertEqual((milestone.total, milestone.opened), (3, 2))
+        query = FakeConnection.requests[1][1].split('?')[1].split('&')
+        self.assertTrue('page=2' in query and 'per_page=2' in query)
+
+    def test_streamed_milestones_not_paginated(self):
+        page = '{"issues": [%s, %s, %s]}' % (ISSUE_JSON % (1, 'open'),
+                ISSUE_JSON % (2, 'open'), ISSUE_JSON % (3, 'closed'))
+        github = make_offline_github([FakeResponse(200, page),
+            FakeResponse(200, page)])
+        issues = list(github.issues.iter_by_label('user/project', 'v0.1', 2))
+        self.assertEqual([issue.number for issue in issues], [1, 2, 3])
+        # The page is larger than page_size: the whole list was returned.
+        self.assertEqual(len(FakeConnection.requests), 1)
+
+        # A list of exactly page_size issues is repeated on the next page.
+        github = make_offline_github([FakeResponse(200, page),
+            FakeResponse(200, page)])
+        issues = list(github.issues.iter_by_label('user/project', 'v0.1', 3))
+        self.assertEqual([issue.number for issue in issues], [1, 2, 3])
+        self.assertEqual(len(FakeConnection.requests), 2)
+
+    def test_index_issues_by_label(self):
+        github = make_fake_github()
+        index = ghmiles.index_issues_by_label(github.issues.issues,
+                ['bug', 'v0.3'])
+        self.assertEqual(sorted(index.keys()), ['bug'])
+        self.assertEqual([issue.number for issue in index['bug']], [2, 6])
+        milestones = list(ghmiles.get_milestones_from_index(['v0.3'], index))
+        self.assertEqual(milestones[0].total, 0)
+        self.assertEqual(milestones[0].progress, 0.0)
+
+    def test_refresh_milestones(self):
+        github = make_fake_github()
+        milestones = list(ghmiles.get_milestones('user/project',
+            ghmiles.MILESTONE_LABEL_V, False, github, bulk=True))
+        issues = github.issues.issues
+        later = '2011/03/01 10:00:00 -0800'
+        issues[2] = make_issue(3, 'closed', ['v0.2'], updated_at=later)
+        issues[4] = make_issue(5, 'open', ['v0.10'], updated_at=later)
+        issues.append(make_issue(7, 'open', ['v0.2'], updated_at=later))
+        issues.append(make_issue(8, 'open', ['v0.1'], updated_at=later))
+        github.issues.calls = []
+
+        ghmiles.refresh_milestones('user/project', milestones, github)
+        (v01, v02, v010) = milestones
+        # v0.1 was completed so it was not refreshed.
+        self.assertEqual(v01.total, 2)
+        self.assertEqual([issue.number for issue in v02.issues], [3, 4, 7])
+        self.assertEqual((v02.opened, v02.closed), (1, 2))
+        self.assertEqual(v010.total, 1)
+        self.assertEqual(v02.synced_at, v010.synced_at)
+        self.assertEqual(len(github.issues.calls), 2)
+
+        # Dates have a one second precision: an issue updated in the second
+        # of the last synchronization may not have been seen.
+        issues.append(make_issue(9, 'open', ['v0.2'], updated_at=later))
+        ghmiles.refresh_milestones('user/project', milestones, github)
+        self.assertEqual([issue.number for issue in v02.issues], [3, 4, 7, 9])
+        self.assertEqual(v02.opened, 2)
+
+        github.issues.calls = []
+        ghmiles.refresh_milestones('user/project', [v01], github)
+        self.assertEqual(github.issues.calls, [])
+
+    def test_snapshot(self):
+        github = make_fake_github()
+        milestones = list(ghmiles.get_milestones('user/project',
+            ghmiles.MILESTONE_LABEL_V, False, github))
+        path = tempfile.mktemp()
+        try:
+            ghmiles.save_snapshot(milestones, path)
+            loaded = ghmiles.load_snapshot(path)
+        finally:
+            os.remove(path)
+        self.assertEqual([m.title for m in loaded], ['v0.1', 'v0.2', 'v0.10'])
+        self.assertEqual(loaded[1].issues[0].title, u'Issue 3')
+        self.assertEqual(loaded[1].content_hash(), milestones[1].content_hash())
+
+        # Fields are restored by name, whatever the order of the slots.
+        record = ghmiles.IssueRecord.__new__(ghmiles.IssueRecord)
+        record.__setstate__((('title', 'number', 'state'),
+            (u'Issue 3', 3, 'open')))
+        self.assertEqual((record.number, record.title), (3, u'Issue 3'))
+        self.assertEqual(record.closed_at, None)
+        pickle.loads(pickle.dumps(record))
+        milestone = ghmiles.Milestone.__new__(ghmiles.Milestone)
+        milestone.__setstate__((('title', 'issues', 'total', 'opened',
+            'closed', 'progress'), ('v0.1', [record], 1, 1, 0, 0.0)))
+        self.assertFalse(milestone.stale)
+        self.assertEqual(milestone.content_hash(),
+                ghmiles.Milestone('v0.1', [record]).content_hash())
+
+    def test_issue_records(self):
+        issues = [make_issue(2, 'closed', ['v0.1']), make_issue(1,
+            labels=['v0.1'])]
+        issues[0].body = u'A long description'
+        milestone = ghmiles.Milestone('v0.1', issues)
+        self.assertTrue(isinstance(milestone.issues[0], ghmiles.IssueRecord))
+        self.assertEqual([issue.number for issue in milestone.issues], [1, 2])
+        self.assertFalse(hasattr(milestone.issues[1], 'body'))
+        self.assertFalse(hasattr(milestone, '__dict__'))
+
+        milestone = ghmiles.Milestone('v0.1', issues, keep_issues=True)
+        self.assertEqual(milestone.issues[1].body, u'A long description')
+
+    def test_intel_milestone_labels(self):
+        (project_labels, labels) = ghmiles.get_intel_milestone_labels(
+                'user/project', False, make_fake_github())
+        self.assertEqual(project_labels, ['v0.1', 'v0.2', 'v0.10'])
+        self.assertEqual(len(labels), 4)
+
+    def test_classify_milestone_labels(self):
+        labels = ['bug', '1.0', 'v1.0', 'v2.0', '2.0beta', 'release-1.2',
+                'release-1.3', 'release-2.0']
+        (scheme, matches) = ghmiles.classify_milestone_labels(labels)
+        # 2.0beta only matches the relaxed numerical scheme.
+        self.assertTrue(scheme is ghmiles.MILESTONE_LABEL_NUM_RELAX)
+        self.assertEqual(matches, ['1.0', '2.0beta'])
+
+        schemes = list(ghmiles.MILESTONE_SCHEMES)
+        regex = ghmiles.register_milestone_scheme(
+                r'^release-\d+(?:\.\d+)*$', schemes)
+        (scheme, matches) = ghmiles.classify_milestone_labels(labels,
+                schemes)
+        self.assertTrue(scheme is regex)
+        self.assertEqual(matches, ['release-1.2', 'release-1.3',
+            'release-2.0'])
+        self.assertEqual(len(ghmiles.MILESTONE_SCHEMES), 4)
+
+
+class TestHtmlPages(unittest.TestCase):
+
+    def setUp(self):
+        self.milestones = list(ghmiles.get_milestones('user/project',
+            ghmiles.MILESTONE_LABEL_V, False, make_fake_github()))
+
+    def test_iter_simple_html_page(self):
+        chunks = list(ghmiles.iter_simple_html_page(self.milestones, 'P'))
+        self.assertEqual(len(chunks), 5)
+        self.assertTrue(chunks[0].startswith('<!DOCTYPE html PUBLIC'))
+        self.assertTrue('Milestone: v0.2' in chunks[2])
+        self.assertTrue(chunks[-1].endswith('</html>'))
+
+    def test_iter_is_lazy(self):
+        def milestones():
+            yield self.milestones[0]
+            raise AssertionError('second milestone requested too early')
+        chunks = ghmiles.iter_fancy_html_page(milestones(), 'user/project')
+        self.assertTrue('project Roadmap' in next(chunks))
+        self.assertTrue('Milestone: v0.1' in next(chunks))
+
+    def test_output(self):
+        output = StringIO.StringIO()
+        self.assertTrue(ghmiles.get_fancy_html_page(self.milestones,
+            'user/project', output=output) is None)
+        html = output.getvalue()
+        self.assertTrue(html.startswith('<!DOCTYPE html PUBLIC'))
+        self.assertTrue(
+            'href="https://github.com/user/project/issues/3"' in html)
+
+    def test_atomic_save_path(self):
+        path = tempfile.mktemp()
+        try:
+            ghmiles.get_simple_html_page(self.milestones, 'P',
+                    save_path=path, atomic=True)
+            with open(path) as page_file:
+                html = page_file.read()
+            self.assertTrue(html.endswith('</html>'))
+            self.assertEqual(html.count('<h2>Milestone'), 3)
+        finally:
+            os.remove(path)
+
+    def test_titles_are_escaped(self):
+        milestone = ghmiles.Milestone('v1.0',
+                [make_issue(1, title=u'Support <b> & "quotes"')])
+        html = ghmiles.get_fancy_html_page([milestone], 'user/project')
+        self.assertTrue(
+            u'Support &lt;b&gt; &amp; "quotes" <strong>- open' in html)
+        self.assertTrue('id="progressbarv1--0"' in html)
+
+    def test_custom_templates(self):
+        templates = ghmiles.RoadmapTemplates('<h1>{0}</h1>', '',
+                '<h2>{title} {percent}%</h2><ul>{issues}</ul>',
+                '<li>{number}</li>')
+        html = ghmiles.get_simple_html_page(self.milestones[:2], 'P',
+                templates=templates)
+        self.assertEqual(html, '<h1>P</h1><h2>v0.1 100%</h2>'
+                '<ul><li>1</li><li>2</li></ul><h2>v0.2 33%</h2>'
+                '<ul><li>3</li><li>4</li><li>5</li></ul>')
+
+    def test_unknown_template_field(self):
+        self.assertRaises(ValueError, ghmiles.RoadmapTemplates, '', '',
+                '{name}', '{number}')
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_site(self):
+        milestones = list(ghmiles.get_milestones('user/project',
+            ghmiles.MILESTONE_LABEL_V, github=make_fake_github()))
+        written = ghmiles.build_roadmap_site(milestones, 'user/project',
+                self.path, gzip=True)
+        self.assertEqual(sorted(written), ['index.html',
+            'milestone-v0.1.html', 'milestone-v0.10.html',
+            'milestone-v0.2.html'])
+        with open(os.path.join(self.path, 'index.html')) as index:
+            self.assertTrue('href="milestone-v0.2.html"' in index.read())
+        page = os.path.join(self.path, 'milestone-v0.1.html')
+        with open(page, 'rb') as page_file:
+            content = page_file.read()
+        with gzip.open(page + '.gz') as gzip_file:
+            self.assertEqual(gzip_file.read(), content)
+
+        milestones[0].update([make_issue(7, 'open', ['v0.10'])])
+        written = ghmiles.build_roadmap_site(milestones[:2], 'user/project',
+                self.path, gzip=True)
+        self.assertEqual(sorted(written), ['index.html',
+            'milestone-v0.10.html'])
+        self.assertFalse(os.path.exists(page))
+        self.assertFalse(os.path.exists(page + '.gz'))
+
+        ghmiles.build_roadmap_site(milestones[:2], 'user/project', self.path)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                [ghmiles.SITE_MANIFEST, 'index.html', 'milestone-v0.10.html',
+                 'milestone-v0.2.html'])
+
+    def test_non_ascii_titles(self):
+        milestones = [ghmiles.Milestone(u'v1 Caf\xe9', [make_issue(1,
+            title=u'Cr\xe8me br\xfbl\xe9e')])]
+        ghmiles.build_roadmap_site(milestones, 'user/project', self.path)
+        page = os.path.join(self.path, ghmiles._milestone_pages(
+            milestones)[0])
+        with open(page, 'rb') as page_file:
+            self.assertTrue(u'Cr\xe8me br\xfbl\xe9e'.encode('utf-8') in
+                    page_file.read())
+        path = os.path.join(self.path, 'simple.html')
+        ghmiles.get_simple_html_page(milestones, u'Caf\xe9', save_path=path)
+        with open(path, 'rb') as page_file:
+            self.assertTrue(u'<h1>Caf\xe9 Roadmap</h1>'.encode('utf-8') in
+                    page_file.read())
+        self.assertTrue(u'Caf\xe9' in ghmiles.get_fancy_html_page(milestones,
+            'user/project'))
+
+    def test_main_site(self):
+        status = ghmiles.main(['-o', self.path, '--site', '-r', '^v',
+            'user/a'], github=make_fake_github())
+        self.assertEqual(status, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'user_a',
+            'milestone-v0.2.html')))
+        with open(os.path.join(self.path, 'index.html')) as index:
+            self.assertTrue('href="user_a/index.html"' in index.read())
+
+    def test_build_roadmaps(self):
+        github = make_fake_github()
+        roadmaps = ghmiles.build_roadmaps(['user/a', 'user/missing',
+            'user/b'], self.path, github, workers=3)
+        self.assertEqual([roadmap.project for roadmap in roadmaps],
+                ['user/a', 'user/missing', 'user/b'])
+        self.assertEqual(len(roadmaps[0].milestones), 3)
+        self.assertTrue(roadmaps[1].error is not None)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                ['index.html', 'user_a.html', 'user_b.html'])
+        with open(os.path.join(self.path, 'index.html')) as index_file:
+            index = index_file.read()
+        self.assertTrue('<a href="user_b.html">user/b</a>: 3 milestones, '
+                '3 of 6 issues closed (50%)' in index)
+        self.assertTrue('user/missing: <em>' in index)
+
+    def test_only_changed_pages_are_written(self):
+        github = make_fake_github()
+        fingerprints = {}
+        ghmiles.build_roadmaps(['user/a', 'user/b'], self.path, github,
+                fingerprints=fingerprints)
+        self.assertEqual(len(fingerprints), 2)
+        for name in os.listdir(self.path):
+            os.utime(os.path.join(self.path, name), (0, 0))
+
+        roadmaps = ghmiles.build_roadmaps(['user/a'], self.path, github,
+                fingerprints=fingerprints)
+        self.assertFalse(roadmaps[0].changed)
+        self.assertEqual(os.path.getmtime(
+            os.path.join(self.path, 'index.html')), 0)
+
+        github.issues.issues[2] = make_issue(3, 'closed', ['v0.2'])
+        roadmaps = ghmiles.build_roadmaps(['user/a'], self.path, github,
+                fingerprints=fingerprints)
+        self.assertTrue(roadmaps[0].changed)
+        self.assertNotEqual(os.path.getmtime(
+            os.path.join(self.path, 'user_a.html')), 0)
+
+    def test_main(self):
+        status = ghmiles.main(['-o', self.path, '--simple', '-r', '^v',
+            'user/a', 'user/b'], github=make_fake_github())
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                ['index.html', 'user_a.html', 'user_b.html'])
+        status = ghmiles.main(['-o', self.path, 'user/missing'],
+                github=make_fake_github())
+        self.assertEqual(status, 1)
+
+
+class TestProgressStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = os.path.join(self.path, 'history.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_runs(self):
+        milestone = ghmiles.Milestone('v0.1', [make_issue(1),
+            make_issue(2, 'closed')])
+        with ghmiles.ProgressStore(self.db) as store:
+            for taken_at in (100, 200, 300):
+                store.record('user/project', [milestone], taken_at)
+            milestone.update([make_issue(1, 'closed', ['v0.1'])])
+            store.record('user/project', [milestone], 400)
+            store.record('user/project', [milestone], 50)
+        store = ghmiles.ProgressStore(self.db)
+        runs = store.history('user/project', 'v0.1')
+        self.assertEqual([(run.start, run.end, run.closed) for run in runs],
+                [(100, 300, 1), (400, 400, 2)])
+        self.assertAlmostEqual(runs[1].progress, 100.0)
+        self.assertEqual(len(store.history('user/project', 'v0.1', 350)), 1)
+        self.assertEqual(len(store.history('user/project', 'v0.1', 0, 99)),
+                0)
+        self.assertEqual(store.labels('user/project'), ['v0.1'])
+        store.close()
+
+    def test_main(self):
+        ghmiles.main(['-o', self.path, '-r', '^v', '--history', self.db,
+            'user/a'], github=make_fake_github())
+        store = ghmiles.ProgressStore(self.db)
+        self.assertEqual(sorted(store.labels('user/a')),
+                ['v0.1', 'v0.10', 'v0.2'])
+        self.assertEqual(store.history('user/a', 'v0.2')[0].opened, 2)
+        store.close()
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        day = lambda number: datetime.datetime(2011, 2, number)
+        a = [ghmiles.Milestone('v0.1', [
+                make_issue(1, 'closed', closed_at=day(1)),
+                make_issue(2, 'closed', closed_at=day(9)),
+                make_issue(3, 'open')]),
+            ghmiles.Milestone('v0.2', [make_issue(3, 'open'),
+                make_issue(4, 'open')])]
+        b = [ghmiles.Milestone('v1', [
+                make_issue(1, 'closed', closed_at=day(2))])]
+        self.table = ghmiles.IssueTable.from_milestones([('user/a', a),
+            ('user/b', b)])
+        self.now = datetime.datetime(2011, 2, 10)
+
+    def test_rollup(self):
+        self.assertEqual(len(self.table), 6)
+        rollups = self.table.rollup('project')
+        self.assertEqual((rollups['user/a'].total, rollups['user/a'].opened),
+                (4, 2))
+        rollups = self.table.rollup('milestone')
+        self.assertAlmostEqual(rollups[('user/b', 'v1')].progress, 100.0)
+        self.assertEqual(rollups[('user/a', 'v0.2')].closed, 0)
+        self.assertRaises(ValueError, self.table.rollup, 'label')
+
+    def test_empty_table(self):
+        for roadmaps in ({}, {'user/a': [ghmiles.Milestone('v1', [])]}):
+            table = ghmiles.IssueTable.from_milestones(roadmaps)
+            self.assertEqual(len(table), 0)
+            rollups = table.rollup('milestone')
+            (weeks, counts) = table.closed_per_week('project')
+            self.assertEqual([count.sum() for count in counts.values()],
+                    [0] * len(roadmaps))
+            table.velocity('project', now=self.now)
+            table.projected_completion('milestone', now=self.now)
+        self.assertEqual(rollups[('user/a', 'v1')].total, 0)
+
+    def test_closed_per_week(self):
+        (weeks, counts) = self.table.closed_per_week('project')
+        self.assertEqual(len(weeks), 2)
+        self.assertEqual(counts['user/a'].tolist(), [1, 1])
+        self.assertEqual(counts['user/b'].tolist(), [1, 0])
+
+    def test_projected_completion(self):
+        velocity = self.table.velocity('project', weeks=2, now=self.now)
+        self.assertAlmostEqual(velocity['user/a'], 1.0)
+        projections = self.table.projected_completion('milestone', weeks=2,
+                now=self.now)
+        self.assertEqual(projections[('user/a', 'v0.1')],
+                datetime.datetime(2011, 2, 17))
+        self.assertEqual(projections[('user/b', 'v1')],
+                datetime.datetime(2011, 2, 2))
+        self.assertTrue(projections[('user/a', 'v0.2')] is None)
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        issues = [make_issue(1, 'closed', ['v0.1', 'bug'],
+                title=u'Caf\xe9, "quoted"',
+                closed_at=datetime.datetime(2011, 2, 3, 4, 5, 6)),
+            make_issue(2, 'open', ['v0.1'])]
+        self.milestones = [ghmiles.Milestone('v0.1', issues),
+                ghmiles.Milestone('v0.2', [])]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        for format in ghmiles.EXPORT_FORMATS:
+            path = os.path.join(self.path, 'milestones.' + format)
+            ghmiles.export_milestones(iter(self.milestones), path, format)
+            milestones = ghmiles.load_milestones(path)
+            self.assertEqual([m.content_hash() for m in milestones],
+                    [m.content_hash() for m in self.milestones])
+            issue = milestones[0].issues[0]
+            self.assertEqual(issue.labels, ('v0.1', 'bug'))
+            self.assertEqual(issue.closed_at,
+                    datetime.datetime(2011, 2, 3, 4, 5, 6))
+            self.assertEqual(issue.updated_at,
+                    datetime.datetime(2011, 2, 1, 10, 0, 0))
+            self.assertEqual((milestones[0].opened, milestones[1].total),
+                    (1, 0))
+
+    def test_streaming(self):
+        output = StringIO.StringIO()
+        ghmiles.export_milestones(self.milestones, output, 'jsonl')
+        self.assertEqual(len(output.getvalue().splitlines()), 2)
+        output.seek(0)
+        self.assertEqual(len(ghmiles.load_milestones(output, 'jsonl')), 2)
+        self.assertRaises(ValueError, ghmiles.export_milestones,
+                self.milestones, output, 'xml')
+
+    def test_main(self):
+        ghmiles.main(['-o', self.path, '-r', '^v', '--export', 'csv',
+            'user/a'], github=make_fake_github())
+        milestones = ghmiles.load_milestones(os.path.join(self.path,
+            'user_a.csv'))
+        self.assertEqual([m.title for m in milestones],
+                ['v0.10', 'v0.2', 'v0.1'])
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_keep_alive(self):
+        body = '{"labels": ["v0.1"]}'
+        github = make_offline_github([FakeResponse(200, body),
+            FakeResponse(200, body, {'Connection': 'close'}),
+            FakeResponse(200, body)])
+        for _ in range(3):
+            self.assertEqual(github.issues.list_labels('user/project'),
+                    ['v0.1'])
+        self.assertEqual(len(FakeConnection.connections), 2)
+        self.assertEqual(github.request.transport.stats()['reused'], 1)
+        self.assertEqual(FakeConnection.requests[0][2]['Accept-Encoding'],
+                'gzip')
+
+    def test_gzip(self):
+        buf = StringIO.StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+        gzip_file.write('{"labels": ["v0.1"]}')
+        gzip_file.close()
+        github = make_offline_github([FakeResponse(200, buf.getvalue(),
+            {'Content-Encoding': 'gzip'})])
+        self.assertEqual(github.issues.list_labels('user/project'), ['v0.1'])
+
+    def test_retry(self):
+        transport = ghmiles.Transport(retries=1, backoff=0)
+        github = make_offline_github([FakeResponse(502, 'Bad Gateway'),
+            FakeResponse(200, '{"labels": []}'),
+            FakeResponse(503, 'Unavailable'), FakeResponse(503, 'Unavailable')],
+            transport=transport)
+        self.assertEqual(github.issues.list_labels('user/project'), [])
+        self.assertRaises(RuntimeError, github.issues.list_labels,
+                'user/project')
+        self.assertEqual(transport.stats()['retried'], 2)
+
+    def test_reused_connection_errors(self):
+        import httplib
+        import socket
+        transport = ghmiles.Transport(retries=0)
+        make_offline_github([FakeResponse(200, 'ok'),
+            httplib.BadStatusLine(''), FakeResponse(200, 'ok'),
+            socket.timeout('timed out'), FakeResponse(200, 'ok'),
+            socket.error('reset')])
+        request = lambda method: transport.request(FakeConnection,
+                'github.com', method, '/', 'a=1' if method == 'POST' else None)
+        self.assertEqual(request('GET').read(), 'ok')
+        # The idle connection was closed without an answer: sent again.
+        self.assertEqual(request('GET').read(), 'ok')
+        self.assertEqual(len(FakeConnection.requests), 3)
+        # A timeout may come after the server got the request.
+        self.assertRaises(socket.timeout, request, 'GET')
+        self.assertEqual(request('GET').read(), 'ok')
+        # POST requests are never sent twice.
+        self.assertRaises(socket.error, request, 'POST')
+        self.assertEqual(len(FakeConnection.requests), 6)
+
+
+class TestAsyncClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ghmiles.AsyncClient(make_fake_github(delay=0.05),
+                workers=4)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_milestones_in_order(self):
+        delivered = []
+        result = self.client.get_milestones('user/project',
+                delivered.append, milestone_regex=ghmiles.MILESTONE_LABEL_V,
+                reverse=False)
+        milestones = result.result(5)
+        self.assertEqual([m.title for m in milestones],
+                ['v0.1', 'v0.2', 'v0.10'])
+        self.assertEqual(delivered, milestones)
+
+    def test_stream_page(self):
+        chunks = []
+        self.client.stream_page('user/project', chunks.append,
+                fancy=False).result(5)
+        self.assertEqual(len(chunks), 5)
+        self.assertTrue('<h2>Milestone: v0.10</h2>' in chunks[1])
+        self.assertTrue('ghmiles' in chunks[-1])
+
+    def test_errback(self):
+        errors = []
+        result = self.client.get_milestones('user/missing',
+                errback=errors.append)
+        self.assertRaises(RuntimeError, result.result, 5)
+        self.assertEqual(len(errors), 1)
+
+    def test_failing_callback(self):
+        def on_milestone(milestone):
+            raise ValueError(milestone.title)
+        errors = []
+        result = self.client.get_milestones('user/project', on_milestone,
+                errback=errors.append,
+                milestone_regex=ghmiles.MILESTONE_LABEL_V, reverse=False)
+        self.assertRaises(ValueError, result.result, 5)
+        self.assertEqual([str(error) for error in errors], ['v0.1'])
+
+        def on_chunk(chunk):
+            if 'Milestone' in chunk:
+                raise IOError('disconnected')
+        result = self.client.stream_page('user/project', on_chunk,
+                fancy=False)
+        self.assertRaises(IOError, result.result, 5)
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_partial_milestones(self):
+        limiter = ghmiles.RateLimiter(requests_per_minute=1, burst=2)
+        github = make_offline_github([
+            FakeResponse(200, '{"labels": ["v0.1", "v0.2", "bug"]}'),
+            FakeResponse(200, '{"issues": [%s]}' % (
+                ISSUE_JSON % (2, 'open')))], rate_limiter=limiter)
+        snapshot = [ghmiles.Milestone('v0.1', [make_issue(1, 'closed')])]
+        start = time.time()
+        (milestones, pending) = ghmiles.get_milestones_within('user/project',
+                1, snapshot, github)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([m.title for m in milestones], ['v0.2', 'v0.1'])
+        self.assertEqual(pending, ['v0.1'])
+        self.assertTrue(milestones[1].stale)
+        self.assertFalse(milestones[0].stale)
+        self.assertFalse(snapshot[0].stale)
+        self.assertTrue(milestones[1] is not snapshot[0])
+        self.assertTrue(limiter.wait_time() > 1)
+        page = ghmiles.get_simple_html_page(milestones)
+        self.assertEqual(page.count(ghmiles.STALE_MARKER), 1)
+
+    def test_snapshot_generator(self):
+        limiter = ghmiles.RateLimiter(requests_per_minute=1, burst=1)
+        limiter.acquire()
+        github = make_offline_github([], rate_limiter=limiter)
+        snapshot = [ghmiles.Milestone('v0.1', [make_issue(1, 'closed')])]
+        (milestones, pending) = ghmiles.get_milestones_within('user/project',
+                1, iter(snapshot), github)
+        self.assertEqual(pending, ['v0.1'])
+        self.assertEqual(milestones[0].total, 1)
+
+    def test_quota_exceeded(self):
+        github = make_offline_github([
+            FakeResponse(200, '{"labels": ["v0.1", "v0.2", "v0.3"]}'),
+            FakeResponse(200, '{"issues": [%s]}' % (
+                ISSUE_JSON % (2, 'open'))),
+            FakeResponse(403, '{"error": "Rate Limit Exceeded"}',
+                {'X-RateLimit-Remaining': '0',
+                 'X-RateLimit-Reset': repr(time.time() + 3600)})],
+            rate_limiter=ghmiles.RateLimiter())
+        snapshot = [ghmiles.Milestone('v0.1', [make_issue(1, 'closed')])]
+        (milestones, pending) = ghmiles.get_milestones_within('user/project',
+                5, snapshot, github)
+        self.assertEqual([m.title for m in milestones],
+                ['v0.3', 'v0.2', 'v0.1'])
+        self.assertEqual(pending, ['v0.2', 'v0.1'])
+        self.assertEqual(milestones[2].total, 1)
+        # The rate limiter holds the last request until the quota is reset.
+        self.assertEqual(len(FakeConnection.requests), 3)
+
+    def test_acquire_max_wait(self):
+        limiter = ghmiles.RateLimiter(requests_per_minute=60, burst=1)
+        limiter.acquire()
+        self.assertRaises(ghmiles.DeadlineExceeded, limiter.acquire, 0.1)
+        self.assertEqual(limiter.stats()['requests'], 1)
+        self.assertTrue(limiter.acquire(2) > 0)
+
+
+class TestDiff(unittest.TestCase):
+
+    def test_diff_milestones(self):
+        old = [ghmiles.Milestone('v0.1', [make_issue(1), make_issue(2),
+                make_issue(3, title=u'Old title')]),
+            ghmiles.Milestone('v0.2', [make_issue(4)]),
+            ghmiles.Milestone('v0.3', [])]
+        new = [ghmiles.Milestone('v0.1', [make_issue(2, 'closed'),
+                make_issue(3, title=u'New title'), make_issue(5)]),
+            ghmiles.Milestone('v0.2', [make_issue(4)]),
+            ghmiles.Milestone('v0.4', [])]
+        events = ghmiles.diff_milestones(old, new)
+        self.assertEqual([(event.kind, event.milestone) for event in events],
+                [(ghmiles.ISSUE_REMOVED, 'v0.1'),
+                 (ghmiles.ISSUE_STATE_CHANGED, 'v0.1'),
+                 (ghmiles.ISSUE_TITLE_CHANGED, 'v0.1'),
+                 (ghmiles.ISSUE_ADDED, 'v0.1'),
+                 (ghmiles.PROGRESS_CHANGED, 'v0.1'),
+                 (ghmiles.MILESTONE_ADDED, 'v0.4'),
+                 (ghmiles.MILESTONE_REMOVED, 'v0.3')])
+        self.assertEqual([event.issue.number for event in events[:4]],
+                [1, 2, 3, 5])
+        self.assertEqual((events[1].old, events[1].new), ('open', 'closed'))
+        self.assertEqual(events[1].describe(), u'v0.1: #2 open -> closed')
+        self.assertAlmostEqual(events[4].new, 100.0 / 3)
+        self.assertEqual(ghmiles.diff_milestones(new, new), [])
+
+    def test_hash_reset_by_update(self):
+        milestone = ghmiles.Milestone('v0.1', [make_issue(1, labels=['v0.1'])])
+        content_hash = milestone.content_hash()
+        milestone.update([make_issue(1, 'closed', ['v0.1'])])
+        self.assertNotEqual(milestone.content_hash(), content_hash)
+        milestone.stale = True
+        self.assertNotEqual(milestone.content_hash(),
+                ghmiles.Milestone('v0.1', milestone.issues).content_hash())
+
+
+def run_script(script):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.call([sys.executable, '-c', script], cwd=directory)
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        script = ('import sys, ghmiles\n'
+                'assert "github2" not in sys.modules\n'
+                'assert "multiprocessing" not in sys.modules\n'
+                'assert not isinstance(object(), ghmiles.Github)\n'
+                'assert "github2" not in sys.modules\n'
+                'ghmiles.Github()\n'
+                'assert "github2" in sys.modules\n')
+        self.assertEqual(run_script(script), 0)
+
+    def test_github_class(self):
+        from github2.client import Github as GithubClient
+
+        class Client(ghmiles.Github):
+            def __init__(self):
+                super(Client, self).__init__(requests_per_minute=30)
+
+        self.assertTrue(isinstance(ghmiles.Github(), ghmiles.Github))
+        self.assertTrue(issubclass(GithubClient, ghmiles.Github))
+        self.assertTrue(isinstance(Client(), GithubClient))
+        self.assertEqual(Client().request.rate_limiter.requests_per_minute,
+                30)
+
+    def test_plain_github2_client(self):
+        # A client created before github2 is patched by ghmiles.
+        script = ('import ghmiles, github2.client\n'
+                'class Response(object):\n'
+                '    status = 200\n'
+                '    def getheader(self, name, default=None):\n'
+                '        return default\n'
+                '    def read(self):\n'
+                '        return \'{"issues": []}\'\n'
+                'class Connection(object):\n'
+                '    def __init__(self, *args, **kwargs): pass\n'
+                '    def request(self, *args): pass\n'
+                '    def getresponse(self): return Response()\n'
+                '    def close(self): pass\n'
+                'github = github2.client.Github()\n'
+                'github.request.connector_for_scheme = {"https": Connection}\n'
+                'milestone = ghmiles.get_milestone("u/p", "v1", github)\n'
+                'assert milestone.total == 0\n')
+        self.assertEqual(run_script(script), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        limiter = ghmiles.RateLimiter(requests_per_minute=600, burst=2)
+        self.assertEqual(limiter.acquire(), 0.0)
+        self.assertEqual(limiter.acquire(), 0.0)
+        start = time.time()
+        self.assertTrue(limiter.acquire() > 0.0)
+        self.assertTrue(time.time() - start >= 0.05)
+        stats = limiter.stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['waits'], 1)
+
+    def test_shared_between_threads(self):
+        limiter = ghmiles.RateLimiter(requests_per_minute=1200, burst=2)
+        threads = [threading.Thread(target=limiter.acquire)
+                for _ in range(6)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 4 tokens are refilled at 20 tokens per second.
+        self.assertTrue(time.time() - start >= 0.18)
+        self.assertEqual(limiter.stats()['waits'], 4)
+
+    def test_server_quota(self):
+        limiter = ghmiles.RateLimiter(requests_per_minute=60)
+        # repr keeps the sub-second precision that str would round away.
+        reset = time.time() + 0.1
+        headers = {'X-RateLimit-Remaining': '0',
+                'X-RateLimit-Reset': repr(reset)}
+        limiter.update_from_headers(headers.get)
+        self.assertEqual(limiter.reset_at, reset)
+        self.assertEqual(limiter.stats()['throttled'], 1)
+        duration = limiter.acquire()
+        self.assertTrue(0.0 < duration <= 0.1)
+        self.assertEqual(limiter.acquire(), 0.0)
+
+    def test_server_quota_far_reset(self):
+        # Local tokens must not be refilled while the server quota is
+        # exhausted.
+        limiter = ghmiles.RateLimiter(requests_per_minute=6000)
+        limiter.update(remaining=0, reset=time.time() + 3600)
+        time.sleep(0.05)
+        self.assertTrue(limiter.wait_time() > 3500)
+        self.assertRaises(ghmiles.DeadlineExceeded, limiter.acquire, 1)
+        self.assertTrue(limiter.wait_time() > 3500)
+        self.assertEqual(limiter.stats()['requests'], 0)
+
+        # Another client reports a renewed quota.
+        limiter.update(remaining=10)
+        self.assertEqual(limiter.wait_time(), 0.0)
+        self.assertEqual(limiter.acquire(1), 0.0)
+
+    def test_shared_between_clients(self):
+        limiter = ghmiles.RateLimiter()
+        github1 = ghmiles.Github(rate_limiter=limiter)
+        github2 = ghmiles.Github(rate_limiter=limiter)
+        self.assertTrue(github1.request.rate_limiter is limiter)
+        self.assertTrue(github2.request.rate_limiter is limiter)
+        self.assertEqual(
+            ghmiles.Github(requests_per_minute=30).request.rate_limiter
+            .requests_per_minute, 30)
+
+    def test_quota_headers_are_read(self):
+        limiter = ghmiles.RateLimiter()
+        github = make_offline_github([FakeResponse(200,
+            '{"labels": ["v0.1", "bug"]}',
+            {'X-RateLimit-Remaining': '0'})], rate_limiter=limiter)
+        self.assertEqual(github.issues.list_labels('user/project'),
+                ['v0.1', 'bug'])
+        self.assertEqual(limiter.stats()['throttled'], 1)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_conditional_request(self):
+        cache = ghmiles.MemoryCache(ttl=0)
+        github = make_offline_github([
+            FakeResponse(200, '{"labels": ["v0.1"]}', {'ETag': '"abc"'}),
+            FakeResponse(304, '')], cache=cache)
+        self.assertEqual(github.issues.list_labels('user/project'), ['v0.1'])
+        self.assertEqual(github.issues.list_labels('user/project'), ['v0.1'])
+        headers = FakeConnection.requests[1][2]
+        self.assertEqual(headers['If-None-Match'], '"abc"')
+
+    def test_fresh_entry_skips_request(self):
+        cache = ghmiles.MemoryCache(ttl=60)
+        github = make_offline_github([
+            FakeResponse(200, '{"labels": ["v0.1"]}')], cache=cache)
+        github.issues.list_labels('user/project')
+        self.assertEqual(github.issues.list_labels('user/project'), ['v0.1'])
+        self.assertEqual(len(FakeConnection.requests), 1)
+
+    def test_memory_cache_eviction(self):
+        cache = ghmiles.MemoryCache(max_entries=2)
+        cache.set('a', {'body': '1', 'stored': time.time()})
+        cache.set('b', {'body': '2', 'stored': time.time()})
+        cache.get('a')
+        cache.set('c', {'body': '3', 'stored': time.time()})
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual(cache.get('a')['body'], '1')
+
+    def test_directory_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = ghmiles.DirectoryCache(path, ttl=60, max_entries=2)
+            for key in ('a', 'b'):
+                cache.set(key, {'body': key, 'stored': time.time()})
+                os.utime(cache._entry_path(key), (0, 0))
+            cache.set('c', {'body': 'c', 'stored': time.time()})
+            self.assertEqual(len(os.listdir(path)), 2)
+            entry = ghmiles.DirectoryCache(path).get('c')
+            self.assertEqual(entry['body'], 'c')
+            self.assertTrue(cache.is_fresh(entry))
+            cache.clear()
+            self.assertTrue(cache.get('c') is None)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_requests(self):
+        events = []
+        metrics = ghmiles.Metrics(callbacks=[
+            lambda kind, event: events.append(kind)])
+        cache = ghmiles.MemoryCache(ttl=60)
+        github = make_offline_github([
+            FakeResponse(200, '{"labels": ["v0.1", "bug"]}')],
+            cache=cache, metrics=metrics)
+        ghmiles.get_intel_milestone_labels('user/project', github=github)
+        github.issues.list_labels('user/project')
+        summary = metrics.summary()
+        self.assertEqual(summary['requests'], 1)
+        self.assertEqual(summary['bytes'], 27)
+        self.assertEqual(summary['cache_hits'], 1)
+        self.assertEqual(summary['phases']['labels']['count'], 1)
+        self.assertEqual(events, ['request', 'phase', 'cache_hit'])
+
+    def test_render_phase(self):
+        metrics = ghmiles.Metrics()
+        milestones = list(ghmiles.get_milestones('user/project',
+            ghmiles.MILESTONE_LABEL_V, github=make_fake_github()))
+        ghmiles.get_fancy_html_page(milestones, 'user/project',
+                metrics=metrics)
+        self.assertEqual(metrics.summary()['phases']['render']['count'], 3)
+        self.assertTrue('"render"' in metrics.to_json())
+
+
         
 if __name__ == '__main__':
     unittest.main()